@@ -4,7 +4,7 @@
 from django.contrib import admin
 from django.shortcuts import render
 
-from .models import PermafrostRole  # , PermafrostCategory
+from .models import PermafrostAuditEvent, PermafrostRole  # , PermafrostCategory
 
 ################
 # ADMIN ACTIONS
@@ -128,6 +128,18 @@ class PermafrostRoleAdmin(admin.ModelAdmin):
     actions = [create_missing_groups, perms_to_code]
 
 
+class PermafrostAuditEventAdmin(admin.ModelAdmin):
+    list_display = ("created", "action", "role", "site", "actor")
+    list_filter = ("action",)
+    ordering = ("-created",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False  # The audit trail is read only
+
+
 # class PermafrostCategoryAdmin(admin.ModelAdmin):
 #     readonly_fields = ('slug',)
 #     list_display = ('name',)
@@ -139,4 +151,5 @@ class PermafrostRoleAdmin(admin.ModelAdmin):
 ###############
 
 admin.site.register(PermafrostRole, PermafrostRoleAdmin)
+admin.site.register(PermafrostAuditEvent, PermafrostAuditEventAdmin)
 # admin.site.register(PermafrostCategory, PermafrostCategoryAdmin)
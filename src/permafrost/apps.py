@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class PermafrostConfig(AppConfig):
     name = "permafrost"
+
+    def ready(self):
+        from .effective import connect_signals
+
+        connect_signals()
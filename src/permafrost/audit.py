@@ -0,0 +1,294 @@
+"""
+Audit trail for Permafrost.
+
+When PERMAFROST_AUDIT is enabled, changes made through PermafrostRoles (role
+saves and deletes, permission and membership changes, object grants) and
+permission checks denied by the Permafrost views are recorded as audit
+events.  Recording an event only appends it to an in-memory buffer: a
+background thread hands the events to the writer in batches, either as
+PermafrostAuditEvent rows with one bulk_create per batch (the default) or as
+JSON lines in a rotating file, so the request path never waits on a write:
+
+    PERMAFROST_AUDIT = True
+    PERMAFROST_AUDIT_WRITER = "permafrost.audit.DatabaseWriter"
+    # PERMAFROST_AUDIT_WRITER = {
+    #     "class": "permafrost.audit.FileWriter",
+    #     "filename": "/var/log/permafrost/audit.log",
+    # }
+    PERMAFROST_AUDIT_BATCH_SIZE = 500
+    PERMAFROST_AUDIT_FLUSH_INTERVAL = 1.0  # Seconds
+    PERMAFROST_AUDIT_MAX_PENDING = 100000
+
+Events of changes made inside a transaction are buffered when it commits and
+dropped if it rolls back.  Pending events are flushed when the process exits.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+from collections import deque
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .deferred import defer
+
+logger = logging.getLogger(__name__)
+
+_active_actor = ContextVar("permafrost_audit_actor", default=None)
+
+
+###############
+# WRITERS
+###############
+
+
+class DatabaseWriter:
+    """
+    Writes each batch of events as PermafrostAuditEvent rows with a single
+    bulk_create.
+    """
+
+    def __init__(self, using="default"):
+        self.using = using
+
+    def __call__(self, events):
+        model = apps.get_model("permafrost", "PermafrostAuditEvent")
+        model.objects.using(self.using).bulk_create(
+            [model(**event) for event in events]
+        )
+
+
+class FileWriter:
+    """
+    Appends each event as a line of JSON to a file, rotated once it reaches
+    max_bytes.
+    """
+
+    def __init__(self, filename, max_bytes=10485760, backup_count=5):
+        self.handler = RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, delay=True
+        )
+
+    def __call__(self, events):
+        for event in events:
+            self.handler.handle(
+                logging.makeLogRecord(
+                    {
+                        "msg": json.dumps(event, cls=DjangoJSONEncoder),
+                        "levelno": logging.INFO,
+                        "levelname": "INFO",
+                    }
+                )
+            )
+
+
+###############
+# BUFFER
+###############
+
+
+class AuditBuffer:
+    """
+    Holds recorded events until a background thread hands them to the
+    writer, batch_size at a time, whenever a batch fills up and at least
+    every flush_interval seconds.  Past max_pending the oldest events are
+    dropped rather than letting a slow writer grow the buffer without bound.
+    """
+
+    def __init__(self, writer, batch_size=500, flush_interval=1.0, max_pending=100000):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.events = deque(maxlen=max_pending)
+        self.dropped = 0
+        self.lock = threading.Lock()  # Held while writing
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = None
+        self.pid = None
+
+    def add(self, events):
+        for event in events:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+
+        self.start()
+        if len(self.events) >= self.batch_size:
+            self.wakeup.set()
+
+    def start(self):
+        if self.pid == os.getpid():  # Forked workers start their own thread
+            return
+
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self.run, name="permafrost-audit", daemon=True
+                )
+                self.thread.start()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            if not self.closed:
+                self.flush()
+                close_old_connections()
+
+    def flush(self):
+        """
+        Writes every pending event, batch_size at a time.
+        """
+        with self.lock:
+            if self.dropped:
+                logger.warning(
+                    "Permafrost audit buffer was full, dropped %s events", self.dropped
+                )
+                self.dropped = 0
+
+            while self.events:
+                batch = []
+                while self.events and len(batch) < self.batch_size:
+                    batch.append(self.events.popleft())
+                try:
+                    self.writer(batch)
+                except Exception:
+                    logger.exception(
+                        "Permafrost audit writer %r failed, lost %s events",
+                        self.writer,
+                        len(batch),
+                    )
+
+    def close(self):
+        """
+        Stops the background thread, writing what is left from the caller.
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.flush()
+
+
+###############
+# STATE
+###############
+
+
+class AuditState:
+    def __init__(self):
+        self.buffer = None
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if self.buffer is not None:
+            self.buffer.close()
+        self.enabled = getattr(settings, "PERMAFROST_AUDIT", False)
+        self.buffer = None  # Built on the first event
+
+    def get_buffer(self):
+        with self.lock:
+            if self.buffer is None:
+                config = getattr(
+                    settings,
+                    "PERMAFROST_AUDIT_WRITER",
+                    "permafrost.audit.DatabaseWriter",
+                )
+                if isinstance(config, str):
+                    config = {"class": config}
+                options = dict(config)
+                self.buffer = AuditBuffer(
+                    import_string(options.pop("class"))(**options),
+                    batch_size=getattr(settings, "PERMAFROST_AUDIT_BATCH_SIZE", 500),
+                    flush_interval=getattr(
+                        settings, "PERMAFROST_AUDIT_FLUSH_INTERVAL", 1.0
+                    ),
+                    max_pending=getattr(
+                        settings, "PERMAFROST_AUDIT_MAX_PENDING", 100000
+                    ),
+                )
+            return self.buffer
+
+
+state = AuditState()
+
+
+@receiver(setting_changed, dispatch_uid="permafrost_audit_settings")
+def reload_settings(setting, **kwargs):
+    if setting.startswith("PERMAFROST_AUDIT"):
+        state.load()
+
+
+@atexit.register
+def flush():
+    """
+    Writes the pending events now, from the calling thread.
+    """
+    if state.buffer is not None:
+        state.buffer.flush()
+
+
+###############
+# RECORDING
+###############
+
+
+def is_enabled():
+    return state.enabled
+
+
+def activate_actor(user):
+    """
+    Makes user the actor of the events recorded in the current context (see
+    PermafrostSiteMiddleware).  Returns a token for deactivate_actor.
+    """
+    return _active_actor.set(user)
+
+
+def deactivate_actor(token):
+    _active_actor.reset(token)
+
+
+def buffer_events(events):
+    state.get_buffer().add(events)
+
+
+def record(action, site=None, role=None, actor=None, on_commit=True, **details):
+    """
+    Records an audit event if auditing is enabled.  site, role and actor may
+    be objects or pks, actor defaulting to the active one; details must be
+    JSON serializable.  With on_commit, an event recorded inside a
+    transaction is only buffered once the transaction commits.
+    """
+    if not state.enabled:
+        return
+
+    if actor is None:
+        actor = _active_actor.get()
+
+    event = {
+        "created": timezone.now(),
+        "action": action,
+        "site_id": getattr(site, "pk", site),
+        "role_id": getattr(role, "pk", role),
+        "actor_id": getattr(actor, "pk", actor),
+        "details": details,
+    }
+
+    pending = defer(buffer_events, list) if on_commit else None
+    if pending is None:
+        buffer_events([event])
+    else:
+        pending.append(event)
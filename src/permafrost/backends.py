@@ -1,4 +1,4 @@
-from django.contrib.auth import get_user_model
+from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.auth.backends import (
     ModelBackend,
@@ -6,26 +6,357 @@ from django.contrib.auth.backends import (
     RemoteUserBackend,
     AllowAllUsersRemoteUserBackend,
 )
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.db import models
+from django.db.models import F
+from django.db.models.functions import Cast
+
+from .cache import (
+    aget_site_permissions,
+    get_cached_permissions,
+    get_site_permissions,
+    set_cached_permissions,
+)
+from . import effective
+from .instrumentation import count_cache, instrumented
+from .models import PermafrostObjectGrant, get_user_groups_query
+from .sites import get_active_site
+
+
+def get_site_permissions_queryset(user_obj, site):
+    """
+    Permissions granted to the user through the Groups of PermafrostRoles on the given site
+    """
+    if effective.is_enabled() and not effective.is_pending(site):
+        # One lookup on the precomputed (user, site, permission) index
+        return Permission.objects.filter(
+            permafrost_effective_permissions__user=user_obj,
+            permafrost_effective_permissions__site=site,
+        )
+
+    return Permission.objects.filter(
+        **{get_user_groups_query(): user_obj}, group__permafrost_role__site=site
+    )  # TODO: Should it return Groups that do not have a Permafrost Role also?
+
+
+def get_site_group_permissions(user_obj, site):
+    """
+    Returns the set of "app_label.codename" strings the user has through
+    PermafrostRoles on the site, using the permission cache when possible.
+    """
+    site_id = getattr(site, "pk", site)
+
+    def load():
+        perms = get_site_permissions_queryset(user_obj, site_id)
+        perms = perms.values_list("content_type__app_label", "codename").order_by()
+        return {"%s.%s" % (ct, name) for ct, name in perms}
+
+    return get_site_permissions(user_obj, site_id, load)
+
+
+def get_object_grants_queryset(user_obj, site_id):
+    return (
+        PermafrostObjectGrant.objects.filter(
+            **{"role__" + get_user_groups_query(): user_obj}, site=site_id
+        )
+        .values_list(
+            "content_type__app_label",
+            "content_type__model",
+            "object_id",
+            "permission__content_type__app_label",
+            "permission__codename",
+        )
+        .order_by()
+    )
+
+
+def add_object_grant(acl, grant):
+    model_app_label, model_name, object_id, app_label, codename = grant
+    acl.setdefault((model_app_label, model_name, object_id), set()).add(
+        "%s.%s" % (app_label, codename)
+    )
+
+
+def get_object_key(obj):
+    """
+    The ACL index key of obj, read from its model so no ContentType has to
+    be looked up.
+    """
+    opts = obj._meta.concrete_model._meta  # Like ContentType.get_for_model
+    return (opts.app_label, opts.model_name, str(obj.pk))
+
+
+def get_site_object_permissions(user_obj, site):
+    """
+    Returns the user's object grants on the site as an ACL index of
+    {(app_label, model_name, object_id): {"app_label.codename", ...}}.  It is
+    loaded with one query and cached on the user object, so any number of
+    object checks on the site are dictionary lookups.
+    """
+    site_id = getattr(site, "pk", site)
+    acl = get_cached_permissions(user_obj, site_id, kind="objects")
+    count_cache(hit=acl is not None)
+
+    if acl is None:
+        acl = {}
+        for grant in get_object_grants_queryset(user_obj, site_id):
+            add_object_grant(acl, grant)
+        set_cached_permissions(user_obj, site_id, acl, kind="objects")
+
+    return acl
+
+
+async def aget_site_object_permissions(user_obj, site):
+    """
+    Async version of get_site_object_permissions, sharing its cache.
+    """
+    site_id = getattr(site, "pk", site)
+    acl = get_cached_permissions(user_obj, site_id, kind="objects")
+    count_cache(hit=acl is not None)
+
+    if acl is None:
+        acl = {}
+        async for grant in get_object_grants_queryset(user_obj, site_id):
+            add_object_grant(acl, grant)
+        set_cached_permissions(user_obj, site_id, acl, kind="objects")
+
+    return acl
+
+
+def get_object_id_expression(model):
+    """
+    PermafrostObjectGrant.object_id as an expression comparable with the
+    model's primary key.
+    """
+    pk = model._meta.pk
+    if pk.is_relation:
+        pk = pk.target_field
+
+    if isinstance(pk, (models.CharField, models.TextField)):
+        return F("object_id")
+    if isinstance(pk, models.IntegerField):  # Includes the AutoFields
+        return Cast("object_id", output_field=models.BigIntegerField())
+    return Cast("object_id", output_field=pk.__class__())
+
+
+def filter_objects_for_user(user_obj, perm, queryset, site):
+    """
+    Filters the queryset down to the objects the user has been granted perm
+    ("app_label.codename") on through their PermafrostRoles on the site.  The
+    grants are matched in a single subquery instead of checking each row.
+    Superusers get the whole queryset.
+    """
+    if not user_obj.is_active or user_obj.is_anonymous:
+        return queryset.none()
+
+    if user_obj.is_superuser:
+        return queryset
+
+    app_label, codename = perm.split(".")
+    object_ids = (
+        PermafrostObjectGrant.objects.filter(
+            **{"role__" + get_user_groups_query(): user_obj},
+            site=getattr(site, "pk", site),
+            content_type=ContentType.objects.get_for_model(queryset.model),
+            permission__content_type__app_label=app_label,
+            permission__codename=codename,
+        )
+        .annotate(object_pk=get_object_id_expression(queryset.model))
+        .values("object_pk")
+    )
+
+    return queryset.filter(pk__in=object_ids)
+
+
+async def aget_site_group_permissions(user_obj, site):
+    """
+    Async version of get_site_group_permissions, using the async ORM.
+    """
+    site_id = getattr(site, "pk", site)
+
+    async def load():
+        perms = get_site_permissions_queryset(user_obj, site_id)
+        perms = perms.values_list("content_type__app_label", "codename").order_by()
+        return {"%s.%s" % (ct, name) async for ct, name in perms}
+
+    return await aget_site_permissions(user_obj, site_id, load)
 
 
 class GroupSiteModelBackendMixin:
+    """
+    Filters the Group permissions on the PermafrostRoles for the current Site.
+    Results are cached on the user object per site id so repeated checks in
+    the same request do not go back to the database.
+    """
+
+    def _get_site_id(self, site=None):
+        if site:
+            return getattr(site, "pk", site)
+
+        active_site = get_active_site()  # Set by PermafrostSiteMiddleware
+        if active_site is not None:
+            return active_site.pk
+
+        return Site.objects.get_current().pk
 
     def _get_group_permissions(self, user_obj, obj=None, site=None):
         """
         Adds the SiteID for filtering Groups
         """
+        return get_site_permissions_queryset(user_obj, self._get_site_id(site))
+
+    def get_group_permissions(self, user_obj, obj=None, site=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        site_id = self._get_site_id(site)
+
+        def load():
+            if user_obj.is_superuser:
+                perms = Permission.objects.all()
+            else:
+                perms = self._get_group_permissions(user_obj, site=site_id)
+            perms = perms.values_list("content_type__app_label", "codename").order_by()
+            return {"%s.%s" % (ct, name) for ct, name in perms}
+
+        # Not the "group" entry, which only holds the PermafrostRole permissions
+        kind = "superuser" if user_obj.is_superuser else "group"
+        return get_site_permissions(user_obj, site_id, load, kind)
+
+    def get_object_permissions(self, user_obj, obj, site=None):
+        """
+        The permissions the user has been granted on obj through their
+        PermafrostRoles on the site.
+        """
+        if not user_obj.is_active or user_obj.is_anonymous:
+            return set()
+
+        acl = get_site_object_permissions(user_obj, self._get_site_id(site))
+        return acl.get(get_object_key(obj), set())
+
+    def get_all_permissions(self, user_obj, obj=None, site=None):
+        if obj is not None and getattr(
+            settings, "PERMAFROST_OBJECT_PERMISSIONS", False
+        ):
+            return self.get_object_permissions(user_obj, obj, site=site)
+
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        site_id = self._get_site_id(site)
+        perms = get_cached_permissions(user_obj, site_id, kind="all")
+
+        if perms is None:
+            perms = set_cached_permissions(
+                user_obj,
+                site_id,
+                {
+                    *self.get_user_permissions(user_obj),
+                    *self.get_group_permissions(user_obj, site=site_id),
+                },
+                kind="all",
+            )
+
+        return perms
+
+    @instrumented("backend.has_perm")
+    def has_perm(self, user_obj, perm, obj=None):
+        return super().has_perm(user_obj, perm, obj)
+
+    @instrumented("backend.has_module_perms")
+    def has_module_perms(self, user_obj, app_label):
+        return super().has_module_perms(user_obj, app_label)
+
+    # Async versions, for checks made from async views.  They share the
+    # caches of the sync methods and query through the async ORM.
+
+    async def _aget_site_id(self, site=None):
         if site:
-            current_site = site
-        else:
-            current_site = Site.objects.get_current()
+            return getattr(site, "pk", site)
 
-        user_groups_field = get_user_model()._meta.get_field("groups")
-        user_groups_query = "group__%s" % user_groups_field.related_query_name()
+        active_site = get_active_site()
+        if active_site is not None:
+            return active_site.pk
 
-        return Permission.objects.filter(
-            **{user_groups_query: user_obj}, group__permafrost_role__site=current_site
-        )  # TODO: Should it return Groups that do not have a Permafrost Role also?
+        site_id = getattr(settings, "SITE_ID", None)
+        if site_id:
+            return site_id  # The Site get_current() would look up
+
+        return Site.objects.get_current().pk  # Raises ImproperlyConfigured
+
+    async def aget_user_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        if not hasattr(user_obj, "_user_perm_cache"):  # ModelBackend's cache
+            if user_obj.is_superuser:
+                perms = Permission.objects.all()
+            else:
+                perms = self._get_user_permissions(user_obj)
+            perms = perms.values_list("content_type__app_label", "codename").order_by()
+            user_obj._user_perm_cache = {
+                "%s.%s" % (ct, name) async for ct, name in perms
+            }
+
+        return user_obj._user_perm_cache
+
+    async def aget_group_permissions(self, user_obj, obj=None, site=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        site_id = await self._aget_site_id(site)
+
+        async def load():
+            if user_obj.is_superuser:
+                perms = Permission.objects.all()
+            else:
+                perms = self._get_group_permissions(user_obj, site=site_id)
+            perms = perms.values_list("content_type__app_label", "codename").order_by()
+            return {"%s.%s" % (ct, name) async for ct, name in perms}
+
+        kind = "superuser" if user_obj.is_superuser else "group"
+        return await aget_site_permissions(user_obj, site_id, load, kind)
+
+    async def aget_object_permissions(self, user_obj, obj, site=None):
+        if not user_obj.is_active or user_obj.is_anonymous:
+            return set()
+
+        acl = await aget_site_object_permissions(
+            user_obj, await self._aget_site_id(site)
+        )
+        return acl.get(get_object_key(obj), set())
+
+    async def aget_all_permissions(self, user_obj, obj=None, site=None):
+        if obj is not None and getattr(
+            settings, "PERMAFROST_OBJECT_PERMISSIONS", False
+        ):
+            return await self.aget_object_permissions(user_obj, obj, site=site)
+
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+
+        site_id = await self._aget_site_id(site)
+        perms = get_cached_permissions(user_obj, site_id, kind="all")
+
+        if perms is None:
+            perms = set_cached_permissions(
+                user_obj,
+                site_id,
+                {
+                    *await self.aget_user_permissions(user_obj),
+                    *await self.aget_group_permissions(user_obj, site=site_id),
+                },
+                kind="all",
+            )
+
+        return perms
+
+    @instrumented("backend.ahas_perm")
+    async def ahas_perm(self, user_obj, perm, obj=None):
+        return user_obj.is_active and perm in await self.aget_all_permissions(
+            user_obj, obj=obj
+        )
 
 
 class PermafrostModelBackend(GroupSiteModelBackendMixin, ModelBackend):
@@ -0,0 +1,9 @@
+"""
+Benchmarks for the Permafrost permission checks and role management.
+
+Run them against a project's settings (e.g. the ``develop`` project) with:
+
+    ./manage.py permbench --sites 20 --roles 5 --users 50 --output results.json
+"""
+
+from .runner import run_benchmarks  # noqa: F401
@@ -0,0 +1,175 @@
+import platform
+import time
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.sites.models import SITE_CACHE
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from permafrost.backends import PermafrostModelBackend
+from permafrost.cache import clear_user_cache
+from permafrost.permissions import PermafrostRESTSitePermission, has_all_permissions
+from permafrost.views import PermafrostRoleManageView, PermafrostRoleUpdateView
+
+from .seed import seed
+
+
+class BenchmarkView:
+    permission_required = ("permafrost.view_permafrostrole",)
+    permission_required_get = ("permafrost.change_permafrostrole",)
+
+
+def measure(name, func, iterations, setup=None):
+    """
+    Calls func() ``iterations`` times, calling setup() (untimed) before each
+    call, and returns the timings and the number of queries per call.
+    """
+    durations = []
+    queries = 0
+
+    for _ in range(iterations):
+        if setup:
+            setup()
+
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+
+        queries += len(context.captured_queries)
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "total_ms": sum(durations) * 1000,
+        "mean_ms": sum(durations) * 1000 / iterations,
+        "min_ms": min(durations) * 1000,
+        "max_ms": max(durations) * 1000,
+        "queries_per_call": queries / iterations,
+    }
+
+
+def run_benchmarks(sites=10, roles=5, users=20, iterations=100, keep=False):
+    """
+    Seeds sites x roles x users and times the Permafrost hot paths against
+    them.  Everything runs in a transaction that is rolled back afterwards
+    unless ``keep`` is set.  Returns a JSON serializable dict.
+    """
+    with transaction.atomic():
+        site_list, role_list, user_list = seed(sites, roles, users)
+        site = site_list[0]
+
+        with override_settings(SITE_ID=site.pk):
+            SITE_CACHE.clear()
+            results = run_site_benchmarks(site, role_list, user_list, iterations)
+        SITE_CACHE.clear()
+
+        if not keep:
+            transaction.set_rollback(True)
+
+    return {
+        "parameters": {
+            "sites": sites,
+            "roles": roles,
+            "users": users,
+            "iterations": iterations,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+        },
+        "results": results,
+    }
+
+
+def run_site_benchmarks(site, role_list, user_list, iterations):
+    factory = RequestFactory()
+    backend = PermafrostModelBackend()
+    site_roles = [role for role in role_list if role.site_id == site.pk]
+    user = user_list[0]
+    perm = "permafrost.view_permafrostrole"
+    check_list = list(BenchmarkView.permission_required) + list(
+        BenchmarkView.permission_required_get
+    )
+
+    # A member of a role on the site that can use the role management views
+    manager = get_user_model().objects.create(username="bench-manager")
+    site_roles[0].group.permissions.add(
+        *Permission.objects.filter(
+            content_type__app_label="permafrost",
+            codename__in=["view_permafrostrole", "change_permafrostrole"],
+        )
+    )
+    site_roles[0].users_add(manager)
+
+    def request(path="/", user=user):
+        request = factory.get(path)
+        request.user = user
+        request.site = site
+        return request
+
+    def new_request():
+        clear_user_cache(user)
+
+    same_request = request()
+    view_request = request(user=manager)
+    role = site_roles[-1]
+    rest_permission = PermafrostRESTSitePermission()
+    rest_view = BenchmarkView()
+
+    def save_role():
+        role.description = "Benchmark %s" % time.perf_counter()
+        role.save()
+
+    def render(view, **kwargs):
+        def call():
+            clear_user_cache(manager)
+            view(view_request, **kwargs).render()
+
+        return call
+
+    return [
+        measure(
+            "backend.has_perm (new request)",
+            lambda: backend.has_perm(user, perm),
+            iterations,
+            setup=new_request,
+        ),
+        measure(
+            "backend.has_perm (same request)",
+            lambda: backend.has_perm(user, perm),
+            iterations,
+        ),
+        measure(
+            "has_all_permissions (new request)",
+            lambda: has_all_permissions(same_request, check_list),
+            iterations,
+            setup=new_request,
+        ),
+        measure(
+            "has_all_permissions (same request)",
+            lambda: has_all_permissions(same_request, check_list),
+            iterations,
+        ),
+        measure(
+            "PermafrostRESTSitePermission.has_permission",
+            lambda: rest_permission.has_permission(same_request, rest_view),
+            iterations,
+            setup=new_request,
+        ),
+        measure("PermafrostRole.save", save_role, iterations),
+        measure(
+            "PermafrostRoleManageView GET",
+            render(PermafrostRoleManageView.as_view()),
+            iterations,
+        ),
+        measure(
+            "PermafrostRoleUpdateView GET",
+            render(PermafrostRoleUpdateView.as_view(), slug=role.slug),
+            iterations,
+        ),
+    ]
@@ -0,0 +1,49 @@
+from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+
+from permafrost.models import CATEGORIES, PermafrostRole
+
+
+def seed(sites=10, roles=5, users=20):
+    """
+    Creates ``sites`` Sites with ``roles`` PermafrostRoles each (cycling
+    through the PERMAFROST_CATEGORIES) and ``users`` Users, each a member of
+    one role on every site.  Returns (sites, roles, users).
+    """
+    User = get_user_model()
+    categories = list(CATEGORIES)
+
+    site_list = Site.objects.bulk_create(
+        [
+            Site(domain="bench-%s.example.com" % i, name="Benchmark %s" % i)
+            for i in range(sites)
+        ]
+    )
+    if not site_list or site_list[0].pk is None:  # Backends without returning pks
+        site_list = list(Site.objects.filter(domain__startswith="bench-"))
+
+    PermafrostRole.objects.provision_sites(
+        site_list,
+        [
+            {"name": "Bench Role %s" % i, "category": categories[i % len(categories)]}
+            for i in range(roles)
+        ],
+    )
+    role_list = list(
+        PermafrostRole.objects.filter(site__in=site_list).order_by("site_id", "pk")
+    )
+
+    User.objects.bulk_create([User(username="bench-user-%s" % i) for i in range(users)])
+    user_list = list(User.objects.filter(username__startswith="bench-user-"))
+
+    roles_by_site = {}
+    for role in role_list:
+        roles_by_site.setdefault(role.site_id, []).append(role)
+
+    PermafrostRole.objects.add_users(
+        (user, site_roles[i % len(site_roles)])
+        for i, user in enumerate(user_list)
+        for site_roles in roles_by_site.values()
+    )
+
+    return site_list, role_list, user_list
@@ -0,0 +1,229 @@
+"""
+Permission caching for Permafrost.
+
+Permissions granted through PermafrostRoles depend on the Site, so they are
+cached on the user object keyed by site id, similar to Django's own
+``_perm_cache``.  Each entry records the site's generation when it was built
+so changes made through a PermafrostRole make older entries stale without
+having to track down every user object that holds one.
+
+Optionally, group permission sets can also be shared between processes
+through one of Django's caches by setting ``PERMAFROST_CACHE`` to a cache
+alias.  Shared entries are keyed by (user id, site id, generation) where the
+generation is a per-site counter stored in the same cache.  Bumping the
+counter orphans every entry for the site, so nothing is ever deleted key by
+key and stale entries simply expire.
+"""
+
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .deferred import defer, has_pending
+from .instrumentation import count_cache
+
+PERMAFROST_PERM_CACHE = "_permafrost_perm_cache"
+
+# Django ModelBackend's own (site agnostic) caches
+DJANGO_PERM_CACHES = ("_perm_cache", "_user_perm_cache", "_group_perm_cache")
+
+_site_generations = defaultdict(int)
+
+
+###############
+# SHARED CACHE
+###############
+
+
+def get_shared_cache(site_id=None):
+    """
+    Returns the Django cache configured with PERMAFROST_CACHE, or None if the
+    shared tier is disabled or, given a site_id, if the site has changes
+    waiting for the current transaction to commit.
+    """
+    alias = getattr(settings, "PERMAFROST_CACHE", None)
+    if alias is None:
+        return None
+    if site_id is not None and has_pending(bump_generations, site_id):
+        return None  # The shared entries do not see this transaction's changes
+    return caches[alias]
+
+
+def get_shared_timeout():
+    return getattr(settings, "PERMAFROST_CACHE_TIMEOUT", 300)
+
+
+def _generation_key(site_id):
+    return "permafrost:generation:%s" % site_id
+
+
+def _permissions_key(user_id, site_id, generation, kind="group"):
+    return "permafrost:perms:%s:%s:%s:%s" % (user_id, site_id, kind, generation)
+
+
+def _new_generation():
+    # Seeded from the clock so a counter that was evicted never restarts at a
+    # value that older entries may still be stored under.
+    return int(time.time() * 1000000)
+
+
+def get_shared_generation(cache, site_id):
+    key = _generation_key(site_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _new_generation(), timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_shared_generation(cache, site_id):
+    key = _generation_key(site_id)
+    try:
+        cache.incr(key)
+    except ValueError:  # Missing or evicted counter
+        cache.add(key, _new_generation(), timeout=None)
+
+
+async def aget_shared_generation(cache, site_id):
+    key = _generation_key(site_id)
+    generation = await cache.aget(key)
+    if generation is None:
+        await cache.aadd(key, _new_generation(), timeout=None)
+        generation = await cache.aget(key)
+    return generation
+
+
+###############
+# GENERATIONS
+###############
+
+
+def get_site_generation(site_id):
+    return _site_generations[site_id]
+
+
+def bump_generations(site_ids):
+    shared = get_shared_cache()
+
+    for site_id in site_ids:
+        _site_generations[site_id] += 1
+        if shared is not None:
+            bump_shared_generation(shared, site_id)
+
+
+def invalidate_site(*site_ids):
+    """
+    Marks every cached permission set for the given site(s) as stale.
+
+    Inside a transaction the local generations are bumped right away, for
+    reads made in the transaction, and the bump is repeated (along with the
+    shared cache's) once when it commits, however many changes it made.
+    """
+    pending = defer(bump_generations)
+
+    if pending is None:
+        bump_generations(site_ids)
+    else:
+        for site_id in site_ids:
+            _site_generations[site_id] += 1
+        pending.update(site_ids)
+
+
+###############
+# USER CACHE
+###############
+
+
+def get_cached_permissions(user_obj, site_id, kind="group"):
+    """
+    Returns the cached permission set of the given kind ('group', 'superuser'
+    or 'all') for the user on the site, or None if it is missing or stale.
+    """
+    entry = getattr(user_obj, PERMAFROST_PERM_CACHE, {}).get((site_id, kind))
+
+    if entry is None or entry[0] != _site_generations[site_id]:
+        return None
+
+    return entry[1]
+
+
+def set_cached_permissions(user_obj, site_id, perms, kind="group", generation=None):
+    if generation is None:
+        generation = _site_generations[site_id]
+
+    if not hasattr(user_obj, PERMAFROST_PERM_CACHE):
+        setattr(user_obj, PERMAFROST_PERM_CACHE, {})
+
+    getattr(user_obj, PERMAFROST_PERM_CACHE)[(site_id, kind)] = (generation, perms)
+    return perms
+
+
+def get_site_permissions(user_obj, site_id, loader, kind="group"):
+    """
+    Returns the user's permission set of the given kind for the site, checking
+    the user object first, then the shared cache (if enabled) and finally
+    calling loader() to build it from the database.
+    """
+    perms = get_cached_permissions(user_obj, site_id, kind)
+    if perms is not None:
+        count_cache(hit=True)
+        return perms
+
+    generation = _site_generations[site_id]  # Read before loading to avoid races
+    shared = get_shared_cache(site_id)
+
+    if shared is None:
+        perms = loader()
+        count_cache(hit=False)
+    else:
+        key = _permissions_key(
+            user_obj.pk, site_id, get_shared_generation(shared, site_id), kind
+        )
+        perms = shared.get(key)
+        count_cache(hit=perms is not None)
+        if perms is None:
+            perms = loader()
+            shared.set(key, perms, get_shared_timeout())
+
+    return set_cached_permissions(user_obj, site_id, perms, kind, generation)
+
+
+async def aget_site_permissions(user_obj, site_id, loader, kind="group"):
+    """
+    Async version of get_site_permissions, loader being a coroutine function.
+    Uses the same user object and shared cache entries.
+    """
+    perms = get_cached_permissions(user_obj, site_id, kind)
+    if perms is not None:
+        count_cache(hit=True)
+        return perms
+
+    generation = _site_generations[site_id]
+    shared = get_shared_cache(site_id)
+
+    if shared is None:
+        perms = await loader()
+        count_cache(hit=False)
+    else:
+        key = _permissions_key(
+            user_obj.pk, site_id, await aget_shared_generation(shared, site_id), kind
+        )
+        perms = await shared.aget(key)
+        count_cache(hit=perms is not None)
+        if perms is None:
+            perms = await loader()
+            await shared.aset(key, perms, get_shared_timeout())
+
+    return set_cached_permissions(user_obj, site_id, perms, kind, generation)
+
+
+def clear_user_cache(*users):
+    """
+    Drops the Permafrost and Django permission caches from the user objects.
+    """
+    for user_obj in users:
+        for cache_name in (PERMAFROST_PERM_CACHE,) + DJANGO_PERM_CACHES:
+            if hasattr(user_obj, cache_name):
+                delattr(user_obj, cache_name)
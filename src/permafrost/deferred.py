@@ -0,0 +1,100 @@
+"""
+Coalescing the work Permafrost does after role changes.
+
+Changes made inside a transaction are not visible to other connections until
+it commits, so bumping shared cache generations or recomputing effective
+permissions before then is wasted work (and lets other processes cache
+permissions that are about to change).  Inside a transaction the work is
+collected in a Batch per savepoint and applied once from
+``transaction.on_commit``: a bulk edit calling users_add() a thousand times
+invalidates each site once, and the work of a savepoint that rolls back is
+dropped with it.
+Outside of a transaction (autocommit) it is applied right away.
+"""
+
+from asgiref.local import Local
+from django.db import transaction
+
+_state = Local()
+
+
+class Batch:
+    """
+    The work collected during the current transaction, or savepoint, that
+    key identifies: one accumulator per handler, passed to the handler when
+    the transaction commits.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.pending = {}
+
+    def apply(self):
+        batches = getattr(_state, "batches", {})
+        if batches.get(self.key) is self:
+            del batches[self.key]
+
+        pending, self.pending = self.pending, {}
+        for handler, accumulator in pending.items():
+            handler(accumulator)
+
+
+def is_registered(connection, batch):
+    return any(entry[1] == batch.apply for entry in connection.run_on_commit)
+
+
+def get_batches(connection):
+    """
+    The batches of the current transaction by savepoint, dropping those whose
+    callback went with a rolled back savepoint (or transaction) along with
+    the changes they were collected for.
+    """
+    batches = getattr(_state, "batches", None)
+    if batches is None:
+        batches = _state.batches = {}
+
+    for key, batch in list(batches.items()):
+        if not is_registered(connection, batch):
+            del batches[key]
+    return batches
+
+
+def defer(handler, factory=set):
+    """
+    Returns the accumulator for handler in the current savepoint's batch
+    (created with factory), for the caller to add its keys to, or None
+    outside of a transaction where the caller should apply its change
+    immediately.  handler(accumulator) runs when the transaction commits,
+    once per savepoint that was not rolled back.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+
+    batches = get_batches(connection)
+    key = tuple(sid for sid in connection.savepoint_ids if sid)  # None: no savepoint
+    batch = batches.get(key)
+    if batch is None:
+        # Registered inside the savepoint so Django drops it on rollback
+        batch = batches[key] = Batch(key)
+        transaction.on_commit(batch.apply)
+
+    if handler not in batch.pending:
+        batch.pending[handler] = factory()
+    return batch.pending[handler]
+
+
+def has_pending(handler, key):
+    """
+    Whether key was added to handler's accumulator by work waiting for the
+    current transaction to commit.
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        _state.batches = {}
+        return False
+
+    return any(
+        key in batch.pending.get(handler, ())
+        for batch in get_batches(connection).values()
+    )
@@ -0,0 +1,339 @@
+"""
+The optional effective permission table.
+
+With PERMAFROST_EFFECTIVE_PERMISSIONS enabled, every permission a user has on
+a site through PermafrostRoles is stored as a PermafrostEffectivePermission
+row, so permission checks read a single indexed table instead of joining
+users, Groups, roles and permissions.  The rows are kept up to date from the
+m2m_changed signals of User.groups and Group.permissions, PermafrostRole
+saves and deletes and the bulk role APIs, once per transaction (see
+permafrost.deferred).  ``manage.py permrebuild`` builds
+the table from scratch, which is needed when enabling it on existing data.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sites.models import Site
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from .cache import invalidate_site
+from .deferred import defer, has_pending
+from .models import (
+    PermafrostEffectivePermission,
+    PermafrostRole,
+    batched,
+    get_user_groups_query,
+    get_user_groups_through,
+    role_users_changed,
+)
+
+
+def is_enabled():
+    return getattr(settings, "PERMAFROST_EFFECTIVE_PERMISSIONS", False)
+
+
+def get_granted_rows(user_ids=None, site_ids=None, permission_ids=None):
+    """
+    The (user_id, site_id, permission_id) rows the PermafrostRoles grant,
+    optionally limited to the given users, sites and permissions.
+    """
+    user_groups_query = get_user_groups_query()
+    filters = {user_groups_query + "__isnull": False}
+    if user_ids is not None:
+        filters[user_groups_query + "__in"] = user_ids
+    if site_ids is not None:
+        filters["group__permafrost_role__site__in"] = site_ids
+    else:
+        filters["group__permafrost_role__isnull"] = False
+    if permission_ids is not None:
+        filters["pk__in"] = permission_ids
+
+    return (
+        Permission.objects.filter(**filters)
+        .values_list(user_groups_query, "group__permafrost_role__site", "pk")
+        .order_by()
+        .distinct()
+    )
+
+
+def recompute(user_ids=None, site_ids=None, permission_ids=None):
+    """
+    Brings the stored rows of the given users on the given sites (and, if
+    given, for the given permissions) in line with their roles, writing only
+    the rows that changed.  None means all.
+    """
+    if not is_enabled():
+        return
+    if user_ids is not None and not user_ids:
+        return
+    if site_ids is not None and not site_ids:
+        return
+
+    stored = PermafrostEffectivePermission.objects.all()
+    if user_ids is not None:
+        stored = stored.filter(user_id__in=user_ids)
+    if site_ids is not None:
+        stored = stored.filter(site_id__in=site_ids)
+    if permission_ids is not None:
+        stored = stored.filter(permission_id__in=permission_ids)
+
+    with transaction.atomic():
+        granted = set(get_granted_rows(user_ids, site_ids, permission_ids))
+        stale, changed_site_ids = [], set()
+        for pk, *row in stored.values_list(
+            "pk", "user_id", "site_id", "permission_id"
+        ).order_by():
+            row = tuple(row)
+            if row in granted:
+                granted.discard(row)
+            else:
+                stale.append(pk)
+                changed_site_ids.add(row[1])
+
+        for batch in batched(stale, 1000):
+            PermafrostEffectivePermission.objects.filter(pk__in=batch).delete()
+
+        PermafrostEffectivePermission.objects.bulk_create(
+            [
+                PermafrostEffectivePermission(
+                    user_id=user_id, site_id=site_id, permission_id=permission_id
+                )
+                for user_id, site_id, permission_id in granted
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        changed_site_ids.update(site_id for user_id, site_id, permission_id in granted)
+
+    # Again, as the role changes bumped the generations before the table was
+    # written and permissions read in between may have been cached.
+    invalidate_site(*changed_site_ids)
+
+
+def apply_recomputes(pending):
+    """
+    Runs the recomputes collected during a transaction, one per site.
+    """
+    for site_id, (user_ids, permission_ids) in pending.items():
+        recompute(user_ids, [site_id], permission_ids)
+
+
+def schedule_recompute(user_ids, site_ids, permission_ids=None):
+    """
+    Recomputes the rows of the given users on the given sites, once for the
+    whole transaction when called inside one.
+    """
+    pending = defer(apply_recomputes, dict)
+
+    if pending is None:
+        recompute(user_ids, site_ids, permission_ids)
+        return
+
+    for site_id in site_ids:
+        users, permissions = pending.setdefault(site_id, (set(), set()))
+        users.update(user_ids)
+        if permission_ids is None or permissions is None:
+            pending[site_id] = (users, None)  # All permissions
+        else:
+            permissions.update(permission_ids)
+
+
+def is_pending(site):
+    """
+    Whether rows for the site are waiting for the transaction to commit, in
+    which case the table can not be read for it yet.
+    """
+    return has_pending(apply_recomputes, getattr(site, "pk", site))
+
+
+def rebuild(batch_size=10000):
+    """
+    Replaces the whole table with the rows the PermafrostRoles grant.
+    Returns the number of rows written.
+    """
+    count = 0
+
+    with transaction.atomic():
+        PermafrostEffectivePermission.objects.all().delete()
+        rows = get_granted_rows().iterator(chunk_size=batch_size)
+        for batch in batched(rows, batch_size):
+            PermafrostEffectivePermission.objects.bulk_create(
+                [
+                    PermafrostEffectivePermission(
+                        user_id=user_id, site_id=site_id, permission_id=permission_id
+                    )
+                    for user_id, site_id, permission_id in batch
+                ]
+            )
+            count += len(batch)
+
+    invalidate_site(*Site.objects.values_list("pk", flat=True))
+    return count
+
+
+###############
+# SIGNALS
+###############
+
+
+def get_group_site_ids(group_ids):
+    return set(
+        PermafrostRole.objects.filter(group_id__in=group_ids).values_list(
+            "site_id", flat=True
+        )
+    )
+
+
+def get_group_user_ids(group_ids):
+    through, user_attr, group_attr = get_user_groups_through()
+    return set(
+        through.objects.filter(**{group_attr + "__in": group_ids}).values_list(
+            user_attr, flat=True
+        )
+    )
+
+
+def user_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    m2m_changed of User.groups: a user joined or left role Groups.
+    """
+    if action == "pre_clear":  # Remember what is about to be cleared
+        if reverse:
+            instance._permafrost_cleared = get_group_user_ids([instance.pk])
+        else:
+            instance._permafrost_cleared = set(
+                instance.groups.values_list("pk", flat=True)
+            )
+        return
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_permafrost_cleared", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    if reverse:  # instance is a Group, pk_set are users
+        schedule_recompute(pk_set, get_group_site_ids([instance.pk]))
+    else:
+        schedule_recompute([instance.pk], get_group_site_ids(pk_set))
+
+
+def group_permissions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    m2m_changed of Group.permissions: a role Group gained or lost permissions.
+    """
+    if action == "pre_clear":
+        if reverse:
+            instance._permafrost_cleared = set(
+                instance.group_set.values_list("pk", flat=True)
+            )
+        else:
+            instance._permafrost_cleared = set(
+                instance.permissions.values_list("pk", flat=True)
+            )
+        return
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_permafrost_cleared", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    if reverse:  # instance is a Permission, pk_set are Groups
+        group_ids, permission_ids = pk_set, [instance.pk]
+    else:
+        group_ids, permission_ids = [instance.pk], pk_set
+
+    site_ids = get_group_site_ids(group_ids)
+    if site_ids:
+        schedule_recompute(get_group_user_ids(group_ids), site_ids, permission_ids)
+
+
+def role_saving(sender, instance, raw=False, **kwargs):
+    # Remember the stored site (and soft delete) to compare after the save
+    if instance.pk is not None and not raw:
+        instance._permafrost_saved_state = (
+            PermafrostRole.objects.filter(pk=instance.pk)
+            .values_list("site_id", "deleted")
+            .first()
+        )
+
+
+def role_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    A new role can reuse a Group that already has users, and an updated one
+    can move to another site or be soft deleted or restored.  Fixtures (raw
+    saves) are left to permrebuild.
+    """
+    if raw:
+        return
+
+    saved_state = getattr(instance, "_permafrost_saved_state", None)
+    instance._permafrost_saved_state = None
+
+    if created:
+        site_ids = [instance.site_id]
+    elif saved_state is not None and saved_state != (
+        instance.site_id,
+        instance.deleted,
+    ):
+        site_ids = {saved_state[0], instance.site_id}
+    else:
+        return
+
+    schedule_recompute(get_group_user_ids([instance.group_id]), site_ids)
+
+
+def role_deleting(sender, instance, **kwargs):
+    # The Group (and its memberships) go with the role without m2m_changed
+    instance._permafrost_user_ids = get_group_user_ids([instance.group_id])
+
+
+def role_deleted(sender, instance, **kwargs):
+    schedule_recompute(
+        getattr(instance, "_permafrost_user_ids", set()), [instance.site_id]
+    )
+
+
+def role_users_bulk_changed(sender, user_ids, site_ids, **kwargs):
+    schedule_recompute(user_ids, site_ids)
+
+
+def get_receivers():
+    user_groups = get_user_model()._meta.get_field("groups").remote_field.through
+    return [
+        (m2m_changed, user_groups_changed, user_groups),
+        (m2m_changed, group_permissions_changed, Group.permissions.through),
+        (pre_save, role_saving, PermafrostRole),
+        (post_save, role_saved, PermafrostRole),
+        (pre_delete, role_deleting, PermafrostRole),
+        (post_delete, role_deleted, PermafrostRole),
+        (role_users_changed, role_users_bulk_changed, PermafrostRole),
+    ]
+
+
+def connect_signals():
+    """
+    Connects the handlers when the table is enabled.  They are left out
+    otherwise as m2m_changed receivers make every Group add() run an extra
+    query.
+    """
+    for signal, handler, sender in get_receivers():
+        if is_enabled():
+            signal.connect(handler, sender=sender, dispatch_uid=handler.__name__)
+        else:
+            signal.disconnect(handler, sender=sender, dispatch_uid=handler.__name__)
+
+
+@receiver(setting_changed, dispatch_uid="permafrost_effective_settings")
+def reload_settings(setting, **kwargs):
+    if setting == "PERMAFROST_EFFECTIVE_PERMISSIONS":
+        connect_signals()
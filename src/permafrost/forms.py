@@ -8,7 +8,12 @@ from django.forms.fields import CharField, ChoiceField, BooleanField
 from django.forms.models import ModelMultipleChoiceField
 from django.forms.widgets import CheckboxInput
 from django.utils.translation import gettext_lazy as _
-from .models import PermafrostRole, get_optional_by_category, get_choices
+from .models import (
+    PermafrostRole,
+    category_registry,
+    get_choices,
+    get_permission_content_type,
+)
 
 CHOICES = [("", _("Choose Role Type"))] + get_choices()
 
@@ -20,15 +25,16 @@ def assemble_optiongroups_for_widget(permissions):
     optgroups = {}
     if permissions:
         for perm in permissions:
-            if perm.content_type.name in optgroups:
-                optgroups[perm.content_type.name].append(
+            content_type_name = get_permission_content_type(perm).name
+            if content_type_name in optgroups:
+                optgroups[content_type_name].append(
                     (
                         perm.pk,
                         perm.name,
                     )
                 )
             else:
-                optgroups[perm.content_type.name] = [
+                optgroups[content_type_name] = [
                     (
                         perm.pk,
                         perm.name,
@@ -81,7 +87,7 @@ class PermafrostRoleCreateForm(ModelForm):
         labels = LABELS
 
     def __init__(self, *args, **kwargs):
-        self.site = kwargs.pop("site", Site.objects.get_current())
+        self.site = kwargs.pop("site", None) or Site.objects.get_current()
         super().__init__(*args, **kwargs)
         self.fields["category"].choices = CHOICES
 
@@ -91,10 +97,11 @@ class PermafrostRoleCreateForm(ModelForm):
             category = self.instance.category if self.instance.category else category
 
         if category:
-            all_optional_permissions = get_optional_by_category(category=category)
-            ids = [perm.pk for perm in all_optional_permissions]
+            ids = category_registry.optional_ids(category)
 
-            self.fields["permissions"].queryset = Permission.objects.filter(id__in=ids)
+            self.fields["permissions"].queryset = Permission.objects.select_related(
+                "content_type"
+            ).filter(id__in=ids)
 
         bootstrappify(self.fields)
 
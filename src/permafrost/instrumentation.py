@@ -0,0 +1,230 @@
+"""
+Instrumentation for the Permafrost permission checks.
+
+When PERMAFROST_INSTRUMENTATION is enabled, every backend call,
+has_all_permissions call and PermafrostMixin.has_permission call produces a
+CheckRecord with its result, duration, the number of database queries it ran
+and its permission cache hits and misses.  Records are sent through the
+``permission_checked`` signal and to the sinks listed in
+PERMAFROST_INSTRUMENTATION_SINKS:
+
+    PERMAFROST_INSTRUMENTATION = True
+    PERMAFROST_INSTRUMENTATION_SINKS = [
+        "permafrost.instrumentation.LoggingSink",
+        {"class": "permafrost.instrumentation.StatsdSink", "port": 8125},
+    ]
+
+When disabled, the instrumented calls only pay for a single attribute check.
+"""
+
+import logging
+import socket
+import time
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+permission_checked = Signal()  # Sent with a 'record' kwarg
+
+_active_record = ContextVar("permafrost_check_record", default=None)
+
+
+class CheckRecord:
+    """
+    The measurements of one instrumented call.
+    """
+
+    __slots__ = ("name", "result", "duration", "queries", "cache_hits", "cache_misses")
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.duration = 0.0
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+###############
+# SINKS
+###############
+
+
+class LoggingSink:
+    """
+    Writes each record to a logger (DEBUG level) with the measurements in
+    the record's 'permafrost' attribute.
+    """
+
+    def __init__(self, logger="permafrost.instrumentation", level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def __call__(self, record):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(
+                self.level,
+                "%s result=%s duration=%.3fms queries=%s cache_hits=%s cache_misses=%s",
+                record.name,
+                record.result,
+                record.duration * 1000,
+                record.queries,
+                record.cache_hits,
+                record.cache_misses,
+                extra={"permafrost": record.as_dict()},
+            )
+
+
+class StatsdSink:
+    """
+    Sends each record as statsd metrics over UDP, fire-and-forget.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="permafrost"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def __call__(self, record):
+        name = "%s.%s" % (self.prefix, record.name.replace(" ", "_"))
+        lines = [
+            "%s.calls:1|c" % name,
+            "%s.duration:%.3f|ms" % (name, record.duration * 1000),
+            "%s.queries:%s|c" % (name, record.queries),
+            "%s.cache_hits:%s|c" % (name, record.cache_hits),
+            "%s.cache_misses:%s|c" % (name, record.cache_misses),
+        ]
+        if record.result is False:
+            lines.append("%s.denied:1|c" % name)
+
+        try:
+            self.socket.sendto("\n".join(lines).encode(), self.address)
+        except OSError:
+            pass  # Metrics must never break a permission check
+
+
+###############
+# STATE
+###############
+
+
+class InstrumentationState:
+    def __init__(self):
+        self.load()
+
+    def load(self):
+        self.enabled = getattr(settings, "PERMAFROST_INSTRUMENTATION", False)
+        self.sinks = None  # Built on first emit
+
+    def get_sinks(self):
+        if self.sinks is None:
+            sinks = []
+            for config in getattr(settings, "PERMAFROST_INSTRUMENTATION_SINKS", []):
+                if isinstance(config, str):
+                    config = {"class": config}
+                options = dict(config)
+                sinks.append(import_string(options.pop("class"))(**options))
+            self.sinks = sinks
+        return self.sinks
+
+
+state = InstrumentationState()
+
+
+@receiver(setting_changed, dispatch_uid="permafrost_instrumentation_settings")
+def reload_settings(setting, **kwargs):
+    if setting.startswith("PERMAFROST_INSTRUMENTATION"):
+        state.load()
+
+
+def emit(record):
+    permission_checked.send(sender=CheckRecord, record=record)
+
+    for sink in state.get_sinks():
+        try:
+            sink(record)
+        except Exception:
+            logger.exception("Permafrost instrumentation sink %r failed", sink)
+
+
+###############
+# INSTRUMENTING
+###############
+
+
+def instrumented(name):
+    """
+    Decorator that records the call when instrumentation is enabled.  Calls
+    made inside an already instrumented call are counted in the outer record.
+    Coroutine functions are supported, but as the async ORM runs queries in
+    another thread their records do not count queries.
+    """
+
+    def decorator(func):
+        if iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not state.enabled or _active_record.get() is not None:
+                    return await func(*args, **kwargs)
+
+                record = CheckRecord(name)
+                token = _active_record.set(record)
+                start = time.perf_counter()
+                try:
+                    record.result = await func(*args, **kwargs)
+                finally:
+                    record.duration = time.perf_counter() - start
+                    _active_record.reset(token)
+
+                emit(record)
+                return record.result
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not state.enabled or _active_record.get() is not None:
+                return func(*args, **kwargs)
+
+            record = CheckRecord(name)
+            token = _active_record.set(record)
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(record.count_query):
+                    record.result = func(*args, **kwargs)
+            finally:
+                record.duration = time.perf_counter() - start
+                _active_record.reset(token)
+
+            emit(record)
+            return record.result
+
+        return wrapper
+
+    return decorator
+
+
+def count_cache(hit):
+    record = _active_record.get()
+    if record is not None:
+        if hit:
+            record.cache_hits += 1
+        else:
+            record.cache_misses += 1
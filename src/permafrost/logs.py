@@ -0,0 +1,210 @@
+"""
+Logging of denied permission checks.
+
+PermafrostLogMixin logs each denied check to the "permafrost" logger (or the
+view's permission_logger) as a record with the check's details in its
+'permafrost' attribute, which JSONFormatter writes as one line of JSON.  The
+user's permission list is only built if a handler actually emits the record.
+
+So that bursts of denied requests (crawlers, credential stuffing) do not turn
+into bursts of logging, records can be sampled and rate limited per user (or
+per IP for anonymous requests):
+
+    PERMAFROST_DENIED_LOG_SAMPLE_RATE = 1.0  # Share of denied checks logged
+    PERMAFROST_DENIED_LOG_RATE_LIMIT = (10, 60)  # At most 10 a minute per key
+    PERMAFROST_DENIED_LOG_RATE_KEY = "user"  # Or "ip"
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from collections.abc import Mapping
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULT_LOGGER = "permafrost"
+
+
+class LazyPermissions:
+    """
+    A sorted list of permissions, built the first time it is used.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.value = None
+
+    def get(self):
+        if self.value is None:
+            self.value = sorted(self.loader())
+        return self.value
+
+    def __str__(self):
+        return ",".join(self.get())
+
+
+class DeniedCheck(Mapping):
+    """
+    The details of a denied check, attached to its log record.  Mapping
+    access resolves the lazy permission lists.
+    """
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __getitem__(self, key):
+        value = self.fields[key]
+        if isinstance(value, LazyPermissions):
+            return value.get()
+        return value
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one line of JSON with the time, level, logger and
+    message, plus the fields of the record's 'permafrost' attribute.
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        data.update(getattr(record, "permafrost", None) or {})
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+###############
+# SAMPLING
+###############
+
+
+class RateLimiter:
+    """
+    Allows up to limit events per key in each period (in seconds).  Counts
+    are kept per process in fixed windows; past max_keys the oldest windows
+    are forgotten.
+    """
+
+    def __init__(self, limit, period, max_keys=10000):
+        self.limit = limit
+        self.period = period
+        self.max_keys = max_keys
+        self.windows = {}  # key -> [window start, count]
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if len(self.windows) >= self.max_keys:
+                    self.prune(now)
+                window = self.windows[key] = [now, 0]
+
+            window[1] += 1
+            return window[1] <= self.limit
+
+    def prune(self, now):
+        self.windows = {
+            key: window
+            for key, window in self.windows.items()
+            if now - window[0] < self.period
+        }
+        while len(self.windows) >= self.max_keys:  # Still full, drop the oldest
+            del self.windows[next(iter(self.windows))]
+
+
+class DeniedLogState:
+    def __init__(self):
+        self.load()
+
+    def load(self):
+        self.sample_rate = getattr(settings, "PERMAFROST_DENIED_LOG_SAMPLE_RATE", 1.0)
+        self.rate_key = getattr(settings, "PERMAFROST_DENIED_LOG_RATE_KEY", "user")
+        rate_limit = getattr(settings, "PERMAFROST_DENIED_LOG_RATE_LIMIT", None)
+        self.limiter = RateLimiter(*rate_limit) if rate_limit else None
+
+
+state = DeniedLogState()
+
+
+@receiver(setting_changed, dispatch_uid="permafrost_denied_log_settings")
+def reload_settings(setting, **kwargs):
+    if setting.startswith("PERMAFROST_DENIED_LOG"):
+        state.load()
+
+
+def get_rate_key(user, ip):
+    if state.rate_key == "user" and user.is_authenticated:
+        return "user:%s" % user.pk
+    return "ip:%s" % ip
+
+
+def should_log(user, ip):
+    """
+    Whether a denied check by the user (from ip) is sampled and within the
+    rate limit.
+    """
+    if state.sample_rate < 1 and random.random() >= state.sample_rate:
+        return False
+    if state.limiter is not None:
+        return state.limiter.allow(get_rate_key(user, ip))
+    return True
+
+
+###############
+# LOGGING
+###############
+
+
+def log_denied(logger_name, request, ip, required, load_permissions):
+    """
+    Logs a denied check of the request, load_permissions() returning the
+    user's permissions only if the record is emitted.
+    """
+    logger = logging.getLogger(logger_name or DEFAULT_LOGGER)
+    if not logger.isEnabledFor(logging.INFO) or not should_log(request.user, ip):
+        return
+
+    user_perms = LazyPermissions(load_permissions)
+    view_perms = LazyPermissions(lambda: required)
+
+    logger.info(
+        "Failed-Permission-Check:403:%s:%s:%s:%s:%s:%s:%s",
+        ip,
+        request.user.get_username(),
+        request.user.pk,
+        request.method,
+        request.path,
+        user_perms,
+        view_perms,
+        extra={
+            "permafrost": DeniedCheck(
+                event="permission_denied",
+                ip=ip,
+                username=request.user.get_username(),
+                user_id=request.user.pk,
+                method=request.method,
+                path=request.path,
+                user_permissions=user_perms,
+                required_permissions=view_perms,
+            )
+        },
+    )
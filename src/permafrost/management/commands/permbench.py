@@ -0,0 +1,40 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from permafrost.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+
+    help = "Seed Sites, PermafrostRoles and Users and benchmark the permission checks and role management views"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sites", type=int, default=10)
+        parser.add_argument("--roles", type=int, default=5, help="Roles per site")
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument(
+            "--output", help="Write the JSON results to this file instead of stdout"
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the seeded data instead of rolling it back",
+        )
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(
+            sites=options["sites"],
+            roles=options["roles"],
+            users=options["users"],
+            iterations=options["iterations"],
+            keep=options["keep"],
+        )
+        data = json.dumps(results, indent=4)
+
+        if options["output"]:
+            with open(options["output"], "w") as output:
+                output.write(data)
+        else:
+            self.stdout.write(data)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from permafrost.effective import rebuild
+
+
+class Command(BaseCommand):
+
+    help = "Rebuild the Permafrost effective permission table from the PermafrostRoles"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000)
+
+    def handle(self, *args, **options):
+        count = rebuild(batch_size=options["batch_size"])
+        self.stdout.write("Wrote {0} effective permissions".format(count))
@@ -0,0 +1,93 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.functional import SimpleLazyObject
+
+from .audit import activate_actor, deactivate_actor
+from .backends import aget_site_group_permissions, get_site_group_permissions
+from .permissions import aget_request_user
+from .sites import (
+    activate_site,
+    aget_request_site,
+    deactivate_site,
+    get_request_site,
+)
+
+
+def get_request_permissions(request, site):
+    """
+    The user's permissions through PermafrostRoles on the site, empty for
+    anonymous or inactive users.
+    """
+    user = request.user
+    if not user.is_authenticated or not user.is_active:
+        return frozenset()
+    return get_site_group_permissions(user, site)
+
+
+async def aget_request_permissions(request, site):
+    """
+    Async version of get_request_permissions.
+    """
+    user = await aget_request_user(request)
+    if not user.is_authenticated or not user.is_active:
+        return frozenset()
+    return await aget_site_group_permissions(user, site)
+
+
+class PermafrostSiteMiddleware:
+    """
+    Resolves the Site once per request and sets it as request.site, along
+    with request.permafrost_perms, the user's "app_label.codename"
+    permissions on that Site, loaded the first time they are used (async
+    views await request.apermafrost_perms() instead).  The Site
+    is also activated while the request is handled so the Permafrost backends
+    use it as their default, and the user as the actor of audit events.
+
+    Add it after AuthenticationMiddleware:
+
+        MIDDLEWARE = [
+            ...
+            "django.contrib.auth.middleware.AuthenticationMiddleware",
+            "permafrost.middleware.PermafrostSiteMiddleware",
+            ...
+        ]
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        site = get_request_site(request)
+        request.permafrost_perms = SimpleLazyObject(
+            lambda: get_request_permissions(request, site)
+        )
+
+        token = activate_site(site)
+        actor_token = activate_actor(request.user)
+        try:
+            return self.get_response(request)
+        finally:
+            deactivate_actor(actor_token)
+            deactivate_site(token)
+
+    async def __acall__(self, request):
+        site = await aget_request_site(request)
+        request.permafrost_perms = SimpleLazyObject(
+            lambda: get_request_permissions(request, site)
+        )  # For sync views, which Django runs in a thread
+        request.apermafrost_perms = lambda: aget_request_permissions(request, site)
+
+        token = activate_site(site)
+        actor_token = activate_actor(request.user)
+        try:
+            return await self.get_response(request)
+        finally:
+            deactivate_actor(actor_token)
+            deactivate_site(token)
@@ -0,0 +1,81 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("contenttypes", "0002_remove_content_type_name"),
+        ("permafrost", "0019_auto_20210406_1820"),
+        ("sites", "0002_alter_domain_unique"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PermafrostObjectGrant",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "object_id",
+                    models.CharField(max_length=255, verbose_name="Object ID"),
+                ),
+                (
+                    "content_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="contenttypes.contenttype",
+                        verbose_name="Content Type",
+                    ),
+                ),
+                (
+                    "permission",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="auth.permission",
+                        verbose_name="Permission",
+                    ),
+                ),
+                (
+                    "role",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="object_grants",
+                        to="permafrost.permafrostrole",
+                        verbose_name="Role",
+                    ),
+                ),
+                (
+                    "site",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="permafrost_object_grants",
+                        to="sites.site",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Permafrost Object Grant",
+                "verbose_name_plural": "Permafrost Object Grants",
+                "indexes": [
+                    models.Index(
+                        fields=["site", "content_type", "object_id", "permission"],
+                        name="permafrost_grant_object_idx",
+                    )
+                ],
+                "unique_together": {
+                    ("role", "content_type", "object_id", "permission")
+                },
+            },
+        ),
+    ]
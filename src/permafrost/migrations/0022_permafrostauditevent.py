@@ -0,0 +1,109 @@
+# Generated by Django 5.1.15 on 2026-10-18 13:36
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("permafrost", "0021_permafrosteffectivepermission"),
+        ("sites", "0002_alter_domain_unique"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PermafrostAuditEvent",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="Created",
+                    ),
+                ),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[
+                            ("role_created", "Role Created"),
+                            ("role_updated", "Role Updated"),
+                            ("role_deleted", "Role Deleted"),
+                            ("permissions_added", "Permissions Added"),
+                            ("permissions_removed", "Permissions Removed"),
+                            ("permissions_set", "Permissions Set"),
+                            ("permissions_cleared", "Permissions Cleared"),
+                            ("users_added", "Users Added"),
+                            ("users_removed", "Users Removed"),
+                            ("users_cleared", "Users Cleared"),
+                            ("object_permissions_added", "Object Permissions Added"),
+                            (
+                                "object_permissions_removed",
+                                "Object Permissions Removed",
+                            ),
+                            ("permission_denied", "Permission Denied"),
+                        ],
+                        max_length=32,
+                        verbose_name="Action",
+                    ),
+                ),
+                (
+                    "details",
+                    models.JSONField(blank=True, default=dict, verbose_name="Details"),
+                ),
+                (
+                    "actor",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Actor",
+                    ),
+                ),
+                (
+                    "role",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="permafrost.permafrostrole",
+                        verbose_name="Role",
+                    ),
+                ),
+                (
+                    "site",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="sites.site",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Permafrost Audit Event",
+                "verbose_name_plural": "Permafrost Audit Events",
+                "ordering": ["-created"],
+            },
+        ),
+    ]
@@ -1,21 +1,36 @@
 # import sys
+from copy import copy
+from itertools import islice
+
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.sites.models import Site
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Prefetch, Q
 from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
 
 # from django.contrib.sites.shortcuts import get_current_site
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.utils.text import slugify
 from django.contrib.sites.managers import CurrentSiteManager
-from django.db.models.signals import post_delete
-from django.dispatch import receiver
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import Signal, receiver
 from django.urls import reverse
 
+from . import audit
+from .cache import clear_user_cache, invalidate_site
+
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Sent by the bulk PermafrostRole APIs, which write the User/Group through
+# table directly and so do not send m2m_changed, with 'user_ids' and
+# 'site_ids' kwargs.
+role_users_changed = Signal()
+
 
 ###############
 # CHOICES
@@ -110,47 +125,227 @@ def get_current_site(*args, **kwargs):
     return settings.SITE_ID
 
 
+def resolve_natural_keys(natural_keys):
+    """
+    Looks up Permissions for a collection of (codename, app_label, model)
+    natural keys with a single query.  Returns a dict keyed on the natural key.
+    """
+    natural_keys = {tuple(key) for key in natural_keys}
+    if not natural_keys:
+        return {}
+
+    candidates = Permission.objects.select_related("content_type").filter(
+        codename__in={key[0] for key in natural_keys},
+        content_type__app_label__in={key[1] for key in natural_keys},
+    )
+
+    permissions = {}
+    for permission in candidates:
+        key = (
+            permission.codename,
+            permission.content_type.app_label,
+            permission.content_type.model,
+        )
+        if key in natural_keys:
+            permissions[key] = permission
+
+    return permissions
+
+
+def get_permission_content_type(permission):
+    """
+    Returns the Permission's ContentType without a query, either from a
+    select_related join or from the ContentType cache.
+    """
+    if Permission.content_type.is_cached(permission):
+        return permission.content_type
+    return ContentType.objects.get_for_id(permission.content_type_id)
+
+
 def get_permission_objects(natural_keys_list):
-    permissions = []
+    permissions = resolve_natural_keys(item["permission"] for item in natural_keys_list)
+    result = []
     for item in natural_keys_list:
         try:
-            permission = Permission.objects.get_by_natural_key(*item["permission"])
-            permissions.append(permission)
-        except Permission.DoesNotExist:
+            result.append(permissions[tuple(item["permission"])])
+        except KeyError:
             logger.warning(
                 f'Permission not found in PERMAFROST_CATEGORIES: {item["permission"]}'
             )
-            pass
 
-    return permissions
+    return result
+
+
+class PermafrostCategoryRegistry:
+    """
+    Compiled view of PERMAFROST_CATEGORIES.  All natural keys are resolved in
+    one query the first time the registry is used and the Permission objects
+    and pk sets for each category are kept until it is cleared (after
+    migrations or when a Permission is saved or deleted).
+
+    The Permission objects are shared, treat them as read-only.
+    """
+
+    def __init__(self, categories):
+        self.categories = categories
+        self._data = None
+        self._memo = {}
+
+    def clear(self):
+        self._data = None
+        self._memo = {}
+
+    def build(self):
+        permissions = resolve_natural_keys(
+            item["permission"]
+            for category_data in self.categories.values()
+            for kind in ("required", "optional")
+            for item in category_data.get(kind, [])
+        )
+
+        data = {}
+        for category, category_data in self.categories.items():
+            data[category] = {}
+            for kind in ("required", "optional"):
+                perms = []
+                for item in category_data.get(kind, []):
+                    try:
+                        perms.append(permissions[tuple(item["permission"])])
+                    except KeyError:
+                        logger.warning(
+                            f'Permission not found in PERMAFROST_CATEGORIES: {item["permission"]}'
+                        )
+                data[category][kind] = tuple(perms)
+                data[category][kind + "_ids"] = frozenset(perm.pk for perm in perms)
+            data[category]["all_ids"] = (
+                data[category]["required_ids"] | data[category]["optional_ids"]
+            )
+
+        self._data = data
+        return data
+
+    def get(self, category, key):
+        data = self._data
+        if data is None:
+            data = self.build()
+        return data[category][key]
+
+    def memoize(self, key, factory):
+        """
+        Returns a value derived from the registry, calling factory() to
+        compute it the first time.  It is dropped when the registry is cleared.
+        """
+        memo = self._memo
+        if key not in memo:
+            memo[key] = factory()
+        return memo[key]
+
+    def required(self, category):
+        return self.get(category, "required")
+
+    def optional(self, category):
+        return self.get(category, "optional")
+
+    def required_ids(self, category):
+        return self.get(category, "required_ids")
+
+    def optional_ids(self, category):
+        return self.get(category, "optional_ids")
+
+    def all_ids(self, category):
+        return self.get(category, "all_ids")
+
+
+category_registry = PermafrostCategoryRegistry(CATEGORIES)
 
 
 def get_required_by_category(category):
-    if "required" in CATEGORIES[category]:
-        return get_permission_objects(CATEGORIES[category]["required"])
-    return []
+    # Copies so callers can annotate the objects without touching the registry
+    return [copy(perm) for perm in category_registry.required(category)]
 
 
 def get_optional_by_category(category):
-    if "optional" in CATEGORIES[category]:
-        return get_permission_objects(CATEGORIES[category]["optional"])
-    return []
+    return [copy(perm) for perm in category_registry.optional(category)]
 
 
 def get_all_perms_for_all_categories():
     perms = []
-    for category, category_data in CATEGORIES.items():
-        optional_perms = category_data["optional"]
-        required_perms = category_data["required"]
-        optional_and_required_perms = set(
-            get_permission_objects(optional_perms)
-            + get_permission_objects(required_perms)
-        )
-        perms.extend(optional_and_required_perms)
+    for category in CATEGORIES:
+        optional_and_required_perms = {
+            perm.pk: perm
+            for perm in category_registry.optional(category)
+            + category_registry.required(category)
+        }
+        perms.extend(copy(perm) for perm in optional_and_required_perms.values())
 
     return perms
 
 
+def get_user_groups_query():
+    """
+    The lookup from Permission to the users of its Groups, e.g. 'group__user'.
+    """
+    user_groups_field = get_user_model()._meta.get_field("groups")
+    return "group__%s" % user_groups_field.related_query_name()
+
+
+def get_user_groups_through():
+    """
+    Returns the User <-> Group through model and the attnames of its user and
+    group columns, e.g. (User.groups.through, 'user_id', 'group_id').
+    """
+    field = get_user_model()._meta.get_field("groups")
+    through = field.remote_field.through
+    return (
+        through,
+        through._meta.get_field(field.m2m_field_name()).attname,
+        through._meta.get_field(field.m2m_reverse_field_name()).attname,
+    )
+
+
+def get_permission_lookup(permission, path):
+    """
+    Returns filter kwargs matching a Permission at the given lookup path
+    (e.g. 'group__permissions'), where permission is a Permission, its pk or
+    an "app_label.codename" string.
+    """
+    if isinstance(permission, str):
+        app_label, codename = permission.split(".", 1)
+        return {
+            path + "__content_type__app_label": app_label,
+            path + "__codename": codename,
+        }
+    return {path: getattr(permission, "pk", permission)}
+
+
+def users_with_permission(permission, site=None):
+    """
+    Returns the users that hold the permission through a PermafrostRole, on
+    the given site or on any site if site is None.  Runs as a single join
+    through the users' Groups.
+    """
+    filters = get_permission_lookup(permission, "groups__permissions")
+    filters["groups__permafrost_role__deleted"] = False
+    if site is not None:
+        filters["groups__permafrost_role__site"] = site
+
+    return get_user_model().objects.filter(**filters).distinct()
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def record_membership_changes(action, by_role):
+    """
+    Records one audit event per role for the bulk membership APIs.
+    """
+    for role, user_ids in by_role.items():
+        audit.record(action, site=role.site_id, role=role, users=user_ids)
+
+
 ###############
 # MANAGERS
 ###############
@@ -164,6 +359,227 @@ class PermafrostRoleManager(models.Manager):
     def get_by_natural_key(self, slug, site):
         return self.get(slug=slug, site=site)
 
+    def with_permission(self, permission, site=None, counts=False):
+        """
+        Returns the roles whose Group has the permission (a Permission, its pk
+        or an "app_label.codename" string), on the given site or on any site
+        if site is None.  With counts, each role is annotated with its
+        'user_count'.
+        """
+        filters = get_permission_lookup(permission, "group__permissions")
+        if site is not None:
+            filters["site"] = site
+
+        roles = self.filter(deleted=False, **filters)
+
+        if counts:
+            user_groups_field = get_user_model()._meta.get_field("groups")
+            roles = roles.annotate(
+                user_count=Count(
+                    "group__%s" % user_groups_field.related_query_name(),
+                    distinct=True,
+                )
+            )
+
+        return roles
+
+    def provision_sites(self, sites, roles, batch_size=100):
+        """
+        Creates the given roles on every site in bulk.  ``roles`` is a list of
+        dicts of PermafrostRole field values with at least a 'name' and a
+        'category', e.g. {'name': 'Student', 'category': 'user'}.
+
+        Groups, roles and the Groups' required permissions are written with
+        bulk_create, a few queries per batch of sites, following the same
+        Group naming and required permission rules as PermafrostRole.save.
+        Roles that already exist on a site are skipped.  Returns the list of
+        created roles.
+        """
+        site_ids = [getattr(site, "pk", site) for site in sites]
+        created, reused_group_ids = [], set()
+
+        with transaction.atomic(using=self.db):
+            for batch in batched(site_ids, batch_size):
+                created.extend(self._provision_batch(batch, roles, reused_group_ids))
+
+        for role in created:
+            audit.record(
+                "role_created",
+                site=role.site_id,
+                role=role,
+                name=role.name,
+                category=role.category,
+            )
+        invalidate_site(*site_ids)
+
+        if reused_group_ids:  # Their users now have roles on more sites
+            through, user_attr, group_attr = get_user_groups_through()
+            role_users_changed.send(
+                sender=self.model,
+                user_ids=set(
+                    through.objects.filter(
+                        **{group_attr + "__in": reused_group_ids}
+                    ).values_list(user_attr, flat=True)
+                ),
+                site_ids=set(site_ids),
+            )
+
+        return created
+
+    def _provision_batch(self, site_ids, roles, reused_group_ids):
+        existing = set(self.filter(site_id__in=site_ids).values_list("site_id", "name"))
+
+        new_roles = []
+        for site_id in site_ids:
+            for values in roles:
+                if (site_id, values["name"]) in existing:
+                    continue
+                role = self.model(site_id=site_id, **values)
+                role.slug = slugify(role.name)
+                new_roles.append(role)
+
+        if not new_roles:
+            return []
+
+        # Groups, reusing any that are already named correctly like save() does
+        group_names = {role.get_group_name() for role in new_roles}
+        existing_groups = set(
+            Group.objects.filter(name__in=group_names).values_list("name", flat=True)
+        )
+        Group.objects.bulk_create(
+            [Group(name=name) for name in group_names - existing_groups],
+            ignore_conflicts=True,
+        )
+        group_ids = dict(
+            Group.objects.filter(name__in=group_names).values_list("name", "pk")
+        )
+
+        for role in new_roles:
+            role.group_id = group_ids[role.get_group_name()]
+
+        self.bulk_create(new_roles)
+
+        # Required permissions for the new Groups, existing Groups get conformed
+        GroupPermission = Group.permissions.through
+        GroupPermission.objects.bulk_create(
+            [
+                GroupPermission(group_id=role.group_id, permission_id=perm_id)
+                for role in new_roles
+                if role.get_group_name() not in existing_groups
+                for perm_id in category_registry.required_ids(role.category)
+            ],
+            ignore_conflicts=True,
+        )
+
+        for role in new_roles:
+            if role.get_group_name() in existing_groups:
+                role.conform_group()
+                reused_group_ids.add(role.group_id)
+
+        return new_roles
+
+    def add_users(self, assignments, batch_size=1000):
+        """
+        Adds users to roles in bulk.  ``assignments`` is an iterable of
+        (user, role) pairs, where user is a User or its pk, and may span
+        several roles and sites.  Membership rows are written straight to the
+        User/Group through table with bulk_create, one query per batch.
+        """
+        through, user_attr, group_attr = get_user_groups_through()
+        users, site_ids, by_role = [], set(), {}
+
+        with transaction.atomic(using=self.db):
+            for batch in batched(assignments, batch_size):
+                through.objects.bulk_create(
+                    [
+                        through(
+                            **{
+                                user_attr: getattr(user, "pk", user),
+                                group_attr: role.group_id,
+                            }
+                        )
+                        for user, role in batch
+                    ],
+                    ignore_conflicts=True,
+                )
+                users.extend(user for user, role in batch)
+                site_ids.update(role.site_id for user, role in batch)
+                for user, role in batch:
+                    by_role.setdefault(role, []).append(getattr(user, "pk", user))
+
+        record_membership_changes("users_added", by_role)
+        clear_user_cache(*users)
+        invalidate_site(*site_ids)
+        role_users_changed.send(
+            sender=self.model,
+            user_ids={getattr(user, "pk", user) for user in users},
+            site_ids=site_ids,
+        )
+
+    def remove_users(self, assignments, batch_size=1000):
+        """
+        Removes users from roles in bulk, taking the same (user, role) pairs
+        as add_users.  Runs one filtered delete per batch.
+        """
+        through, user_attr, group_attr = get_user_groups_through()
+        users, site_ids, by_role = [], set(), {}
+
+        with transaction.atomic(using=self.db):
+            for batch in batched(assignments, batch_size):
+                by_group = {}
+                for user, role in batch:
+                    by_group.setdefault(role.group_id, []).append(
+                        getattr(user, "pk", user)
+                    )
+
+                query = Q()
+                for group_id, user_ids in by_group.items():
+                    query |= Q(**{group_attr: group_id, user_attr + "__in": user_ids})
+
+                through.objects.filter(query).delete()
+                users.extend(user for user, role in batch)
+                site_ids.update(role.site_id for user, role in batch)
+                for user, role in batch:
+                    by_role.setdefault(role, []).append(getattr(user, "pk", user))
+
+        record_membership_changes("users_removed", by_role)
+        clear_user_cache(*users)
+        invalidate_site(*site_ids)
+        role_users_changed.send(
+            sender=self.model,
+            user_ids={getattr(user, "pk", user) for user in users},
+            site_ids=site_ids,
+        )
+
+    def for_users(self, users, site):
+        """
+        Returns {user_id: [roles]} with the PermafrostRoles each of the users
+        has on the site.  Memberships and roles come from a single query on
+        the Group join and each role's Group permissions (with their content
+        types) are prefetched in one more, however many users or roles.
+        """
+        user_groups_field = get_user_model()._meta.get_field("groups")
+        member = "group__%s" % user_groups_field.related_query_name()
+        user_ids = [getattr(user, "pk", user) for user in users]
+
+        roles = (
+            self.filter(**{member + "__in": user_ids}, site=site, deleted=False)
+            .annotate(member_id=F(member))
+            .select_related("group")
+            .prefetch_related(
+                Prefetch(
+                    "group__permissions",
+                    queryset=Permission.objects.select_related("content_type"),
+                )
+            )
+            .order_by("name", "pk")
+        )
+
+        by_user = {user_id: [] for user_id in user_ids}
+        for role in roles:
+            by_user[role.member_id].append(role)
+        return by_user
+
 
 ###############
 # MIXINS
@@ -265,29 +681,36 @@ class PermafrostRole(models.Model):
         return self.name in PERMAFROST_DEFAULT_ROLES
 
     def all_perm_ids(self):
-        req = [perm.pk for perm in self.required_permissions()]
-        opt = [perm.pk for perm in self.optional_permissions()]
-        return set(req + opt)
+        return category_registry.all_ids(self.category)
 
-    def conform_group(self):
+    def conform_group(self, current_ids=None):
         """
-        TODO!!!
         Based on the list of permissions in the Category, make sure the group
         has the right set.  Make sure no permissions are outside of the
         optional and required and that all required permissions are added.
 
-        Make sure the Group has the required permissions and all others are
-        within the Optional permissions.
+        Only the missing required and the disallowed permissions are written,
+        the Group's permissions are left alone if they already conform.
+        Returns True if anything was changed.
         """
-        self.permissions_set(
-            self.group.permissions
-        )  # This will check out to make sure all required permissions are present and optionals are allowed
+        if current_ids is None:
+            current_ids = set(self.group.permissions.values_list("pk", flat=True))
+
+        missing = category_registry.required_ids(self.category) - current_ids
+        disallowed = current_ids - self.all_perm_ids()
+
+        if missing:
+            self.group.permissions.add(*missing)
+        if disallowed:
+            self.group.permissions.remove(*disallowed)
+
+        return bool(missing or disallowed)
 
     def get_group_name(self):
         """
         Creates the standard name for the group
         """
-        return "{0}_{1}_{2}".format(self.site.pk, self.category, self.slug)
+        return "{0}_{1}_{2}".format(self.site_id, self.category, self.slug)
 
     def permissions(self):
         return self.group.permissions
@@ -297,32 +720,59 @@ class PermafrostRole(models.Model):
         Add Django permission(s) to the attached group if the permission is in the allowed permissions
         """
         id_check = self.all_perm_ids()
-        for perm in args:
-            if perm.pk in id_check:
-                self.group.permissions.add(perm)
+        perms = [perm for perm in args if perm.pk in id_check]
+        if perms:
+            self.group.permissions.add(*perms)
+            audit.record(
+                "permissions_added",
+                site=self.site_id,
+                role=self,
+                permissions=[perm.pk for perm in perms],
+            )
+
+        invalidate_site(self.site_id)
 
     def permissions_remove(self, *args):
         """
         Remove Django permission(s) from the attached group if the permission is not in the list of required permissions
         """
-        id_check = [required.pk for required in self.required_permissions()]
-        for perm in args:
-            if perm.pk not in id_check:
-                self.group.permissions.remove(perm)
+        id_check = category_registry.required_ids(self.category)
+        perms = [perm for perm in args if perm.pk not in id_check]
+        if perms:
+            self.group.permissions.remove(*perms)
+            audit.record(
+                "permissions_removed",
+                site=self.site_id,
+                role=self,
+                permissions=[perm.pk for perm in perms],
+            )
+
+        invalidate_site(self.site_id)
 
     def permissions_set(self, permissions):
         """
         This updates the group's Django permissions to only include what was passed in and passes the check against optional and required permissions.
         """
-        id_check = [required.pk for required in self.optional_permissions()]
+        id_check = category_registry.optional_ids(self.category)
 
-        optional_perms = [
-            perm for perm in permissions.all() if perm.pk in id_check
-        ]  # perms passed in that meet the optional filter check
-        required_perms = self.required_permissions()
+        if hasattr(permissions, "all"):  # Manager or QuerySet
+            perm_ids = permissions.all().values_list("pk", flat=True)
+        else:
+            perm_ids = [perm.pk for perm in permissions]
 
         # Set to values passed in that are in the optional list plus the required permissions.
-        self.group.permissions.set(optional_perms + required_perms)
+        perm_ids = id_check.intersection(perm_ids) | category_registry.required_ids(
+            self.category
+        )
+        self.group.permissions.set(perm_ids)
+        audit.record(
+            "permissions_set",
+            site=self.site_id,
+            role=self,
+            permissions=sorted(perm_ids),
+        )
+
+        invalidate_site(self.site_id)
 
     def permissions_clear(self):  # TODO: Need to update
         """
@@ -331,9 +781,12 @@ class PermafrostRole(models.Model):
         if CATEGORIES[self.category][
             "required"
         ]:  # If there are any required permissions, set them
-            self.group.permissions.set(self.required_permissions())
+            self.group.permissions.set(category_registry.required_ids(self.category))
         else:  # Otherwise, clear it out completely
             self.group.permissions.clear()
+        audit.record("permissions_cleared", site=self.site_id, role=self)
+
+        invalidate_site(self.site_id)
 
     # -------------
     # Users
@@ -350,18 +803,87 @@ class PermafrostRole(models.Model):
         Pass in a User object to add to the PermafrostRole's Group
         """
         self.group.user_set.add(*users)
+        audit.record(
+            "users_added",
+            site=self.site_id,
+            role=self,
+            users=[getattr(user, "pk", user) for user in users],
+        )
+        clear_user_cache(*users)
+        invalidate_site(self.site_id)
 
     def users_remove(self, *users):
         """
         Pass in a User object to remove from the PermafrostRole's Group
         """
         self.group.user_set.remove(*users)
+        audit.record(
+            "users_removed",
+            site=self.site_id,
+            role=self,
+            users=[getattr(user, "pk", user) for user in users],
+        )
+        clear_user_cache(*users)
+        invalidate_site(self.site_id)
 
     def users_clear(self):
         """
         Remove all users from the PermafrostRole's Group
         """
         self.group.user_set.clear()
+        audit.record("users_cleared", site=self.site_id, role=self)
+        invalidate_site(self.site_id)
+
+    # -------------
+    # Object Permissions
+
+    def object_permissions_add(self, obj, *permissions):
+        """
+        Grant Django permission(s) on a single object to the users of this role
+        """
+        content_type = ContentType.objects.get_for_model(obj)
+        PermafrostObjectGrant.objects.bulk_create(
+            [
+                PermafrostObjectGrant(
+                    role=self,
+                    site_id=self.site_id,
+                    content_type=content_type,
+                    object_id=str(obj.pk),
+                    permission=permission,
+                )
+                for permission in permissions
+            ],
+            ignore_conflicts=True,
+        )
+        audit.record(
+            "object_permissions_added",
+            site=self.site_id,
+            role=self,
+            content_type=content_type.pk,
+            object_id=str(obj.pk),
+            permissions=[permission.pk for permission in permissions],
+        )
+        invalidate_site(self.site_id)
+
+    def object_permissions_remove(self, obj, *permissions):
+        """
+        Revoke Django permission(s) on a single object from the users of this role
+        """
+        content_type = ContentType.objects.get_for_model(obj)
+        self.object_grants.filter(
+            content_type=content_type,
+            object_id=str(obj.pk),
+            permission__in=permissions,
+        ).delete()
+        audit.record(
+            "object_permissions_removed",
+            site=self.site_id,
+            role=self,
+            content_type=content_type.pk,
+            object_id=str(obj.pk),
+            permissions=[permission.pk for permission in permissions],
+        )
+        invalidate_site(self.site_id)
 
     # -------------
     # Save
@@ -370,10 +892,15 @@ class PermafrostRole(models.Model):
         self.slug = slugify(self.name)
         group_name = self.get_group_name()
 
-        if not self.pk:  # if this is a new role, create the matching group
+        current_ids = None
+        new_role = not self.pk
+
+        if new_role:  # if this is a new role, create the matching group
             self.group, created = Group.objects.get_or_create(
                 name=group_name
             )  # Add the group if one named correctly alreay exists, otherwise create a new one.
+            if created:
+                current_ids = set()  # A new Group has no permissions to read
 
         result = super().save(*args, **kwargs)
 
@@ -383,7 +910,17 @@ class PermafrostRole(models.Model):
             self.group.name = group_name
             self.group.save()
 
-        self.conform_group()  # Apply after a successful save and Group creation (if needed)
+        self.conform_group(
+            current_ids
+        )  # Apply after a successful save and Group creation (if needed)
+        audit.record(
+            "role_created" if new_role else "role_updated",
+            site=self.site_id,
+            role=self,
+            name=self.name,
+            category=self.category,
+        )
+        invalidate_site(self.site_id)
 
         return result
 
@@ -395,6 +932,151 @@ class PermafrostRole(models.Model):
             return super().delete()
 
 
+class PermafrostObjectGrant(models.Model):
+    """
+    Grants a Django permission on a single object to the users of a
+    PermafrostRole.  The role's site is copied onto the grant so grants can be
+    looked up by (site, content type, object, permission) with one index.
+    """
+
+    role = models.ForeignKey(
+        PermafrostRole,
+        verbose_name=_("Role"),
+        on_delete=models.CASCADE,
+        related_name="object_grants",
+    )
+    site = models.ForeignKey(
+        Site,
+        on_delete=models.CASCADE,
+        related_name="permafrost_object_grants",
+    )
+    content_type = models.ForeignKey(
+        ContentType, verbose_name=_("Content Type"), on_delete=models.CASCADE
+    )
+    object_id = models.CharField(
+        _("Object ID"), max_length=255
+    )  # A CharField so any primary key type can be referenced
+    permission = models.ForeignKey(
+        Permission, verbose_name=_("Permission"), on_delete=models.CASCADE
+    )
+
+    class Meta:
+        verbose_name = _("Permafrost Object Grant")
+        verbose_name_plural = _("Permafrost Object Grants")
+        unique_together = (("role", "content_type", "object_id", "permission"),)
+        indexes = [
+            models.Index(
+                fields=["site", "content_type", "object_id", "permission"],
+                name="permafrost_grant_object_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return "{0}: {1} on {2} {3}".format(
+            self.role_id, self.permission_id, self.content_type_id, self.object_id
+        )
+
+    def save(self, *args, **kwargs):
+        self.site_id = self.role.site_id
+        return super().save(*args, **kwargs)
+
+
+class PermafrostEffectivePermission(models.Model):
+    """
+    A permission a user has on a site through their PermafrostRoles.  The
+    table is only kept up to date when PERMAFROST_EFFECTIVE_PERMISSIONS is
+    enabled, see permafrost.effective.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="permafrost_effective_permissions",
+    )
+    site = models.ForeignKey(
+        Site,
+        on_delete=models.CASCADE,
+        related_name="permafrost_effective_permissions",
+    )
+    permission = models.ForeignKey(
+        Permission,
+        on_delete=models.CASCADE,
+        related_name="permafrost_effective_permissions",
+    )
+
+    class Meta:
+        verbose_name = _("Permafrost Effective Permission")
+        verbose_name_plural = _("Permafrost Effective Permissions")
+        unique_together = (
+            ("user", "site", "permission"),
+        )  # Also the index permission checks read
+
+    def __str__(self):
+        return "{0}: {1} on {2}".format(self.user_id, self.permission_id, self.site_id)
+
+
+class PermafrostAuditEvent(models.Model):
+    """
+    An entry of the audit trail, written in batches by permafrost.audit.
+    Site, role and actor are not constrained so entries outlive what they
+    refer to.
+    """
+
+    ACTION_CHOICES = (
+        ("role_created", _("Role Created")),
+        ("role_updated", _("Role Updated")),
+        ("role_deleted", _("Role Deleted")),
+        ("permissions_added", _("Permissions Added")),
+        ("permissions_removed", _("Permissions Removed")),
+        ("permissions_set", _("Permissions Set")),
+        ("permissions_cleared", _("Permissions Cleared")),
+        ("users_added", _("Users Added")),
+        ("users_removed", _("Users Removed")),
+        ("users_cleared", _("Users Cleared")),
+        ("object_permissions_added", _("Object Permissions Added")),
+        ("object_permissions_removed", _("Object Permissions Removed")),
+        ("permission_denied", _("Permission Denied")),
+    )
+
+    created = models.DateTimeField(_("Created"), default=timezone.now, db_index=True)
+    action = models.CharField(_("Action"), max_length=32, choices=ACTION_CHOICES)
+    site = models.ForeignKey(
+        Site,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    role = models.ForeignKey(
+        PermafrostRole,
+        verbose_name=_("Role"),
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    actor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_("Actor"),
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )  # The user making the change or denied the permission
+    details = models.JSONField(_("Details"), default=dict, blank=True)
+
+    class Meta:
+        verbose_name = _("Permafrost Audit Event")
+        verbose_name_plural = _("Permafrost Audit Events")
+        ordering = ["-created"]
+
+    def __str__(self):
+        return "{0}: {1} by {2}".format(self.created, self.action, self.actor_id)
+
+
 @receiver(
     post_delete,
     sender=PermafrostRole,
@@ -402,3 +1084,30 @@ class PermafrostRole(models.Model):
 )
 def delete_matching_group(sender, instance, using, **kwargs):
     instance.group.delete()
+    audit.record(
+        "role_deleted", site=instance.site_id, role=instance.pk, name=instance.name
+    )
+    invalidate_site(instance.site_id)
+
+
+@receiver(post_save, sender=PermafrostObjectGrant, dispatch_uid="permafrost_grant_save")
+@receiver(
+    post_delete, sender=PermafrostObjectGrant, dispatch_uid="permafrost_grant_delete"
+)
+def invalidate_object_grant_site(sender, instance, **kwargs):
+    invalidate_site(instance.site_id)
+
+
+@receiver(post_migrate, dispatch_uid="permafrost_category_registry_post_migrate")
+def rebuild_category_registry(sender, **kwargs):
+    category_registry.clear()
+
+
+@receiver(
+    post_save, sender=Permission, dispatch_uid="permafrost_category_registry_save"
+)
+@receiver(
+    post_delete, sender=Permission, dispatch_uid="permafrost_category_registry_delete"
+)
+def clear_category_registry(sender, **kwargs):
+    category_registry.clear()
@@ -2,8 +2,14 @@
 This is a permission class that will only work for Django Rest Framework.
 """
 
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
+from django.db.models import Q
+from django.utils.functional import LazyObject, empty
+
+from .backends import aget_site_group_permissions, get_site_group_permissions
+from .instrumentation import instrumented
+from .models import get_user_groups_query
+from .sites import aget_request_site, get_request_site
 
 try:
     from rest_framework.permissions import BasePermission
@@ -11,6 +17,39 @@ except ImportError:
     # If django rest framework is not installed, make it a useless object
     BasePermission = object
 
+# Merged required permissions per (view class, HTTP method)
+_view_permissions_cache = {}
+
+
+def get_view_permissions(view, method):
+    """
+    Returns a frozenset of the view's permission_required plus the
+    permission_required_<method> perms.  The result is cached per view class
+    and method unless the view instance overrides either attribute.
+    """
+    method_attr = "permission_required_" + method.lower()
+    key = (view.__class__, method_attr)
+    cacheable = not ("permission_required" in vars(view) or method_attr in vars(view))
+
+    if cacheable and key in _view_permissions_cache:
+        return _view_permissions_cache[key]
+
+    perms = getattr(view, "permission_required", set())
+    method_perms = getattr(view, method_attr, set())
+
+    if isinstance(perms, str):
+        perms = (perms,)
+    if isinstance(method_perms, str):
+        method_perms = (method_perms,)
+
+    result = frozenset(perms).union(method_perms)
+
+    if cacheable:
+        _view_permissions_cache[key] = result
+
+    return result
+
+
 # --------------
 # DJANGO REST PERMS
 # --------------
@@ -19,37 +58,27 @@ except ImportError:
 class PermafrostRESTPermission(BasePermission):
 
     def has_permission(self, request, view):
-        perms = getattr(view, "permission_required", set())
-        method_perms = getattr(
-            view, "permission_required_" + request.method.lower(), set()
-        )
+        required = get_view_permissions(view, request.method)
+        if not required:
+            return True
 
-        check_list = list(perms) + list(method_perms)
-        user_perms = list(request.user.get_all_permissions())
+        user_perms = request.user.get_all_permissions()
+        if not isinstance(user_perms, (set, frozenset)):
+            user_perms = frozenset(user_perms)
 
-        # Get the user's perms and check that all the itms in the list are present
-        for perm in check_list:
-            if perm not in user_perms:
-                return False
-
-        return True
+        # Cost only depends on the number of required perms
+        return required.issubset(user_perms)
 
 
 class PermafrostRESTSitePermission(BasePermission):
     """
     This is a permission class that will only work for Django Rest Framework.
-    This class is expecting a middleware that adds the current site to the request.
+    The site is taken from request.site (see PermafrostSiteMiddleware) or
+    resolved from the request when no middleware has set it.
     """
 
     def has_permission(self, request, view):
-        perms = getattr(view, "permission_required", set())
-        method_perms = getattr(
-            view, "permission_required_" + request.method.lower(), set()
-        )
-
-        check_list = list(perms) + list(method_perms)
-
-        return has_all_permissions(request, check_list)
+        return has_all_permissions(request, get_view_permissions(view, request.method))
 
 
 # --------------
@@ -57,6 +86,26 @@ class PermafrostRESTSitePermission(BasePermission):
 # --------------
 
 
+def permissions_granted(check_list, user_permissions):
+    """
+    Checks the check_list against a set of "app_label.codename" strings.  An
+    entry with an empty codename ("app_label.") matches any permission in the
+    app.
+    """
+    for perm in set(check_list).difference(user_permissions):
+        app_label, codename = perm.split(".")
+
+        if codename:
+            return False
+
+        app_prefix = app_label + "."
+        if not any(user_perm.startswith(app_prefix) for user_perm in user_permissions):
+            return False
+
+    return True
+
+
+@instrumented("has_all_permissions")
 def has_all_permissions(request, check_list=[]):
     """
     Checks if request.user the given list of permission on the current request.site
@@ -67,25 +116,101 @@ def has_all_permissions(request, check_list=[]):
     if not request.user.is_authenticated:
         return False
 
-    has_permission = False
+    # One query (or a cache hit) for all of the user's perms on the site
+    user_permissions = get_site_group_permissions(
+        request.user, get_request_site(request)
+    )
 
-    user_groups_field = get_user_model()._meta.get_field("groups")
-    user_groups_query = "group__%s" % user_groups_field.related_query_name()
+    return permissions_granted(check_list, user_permissions)
 
-    user_permissions = Permission.objects.filter(
-        **{user_groups_query: request.user}, group__permafrost_role__site=request.site
-    )
 
-    for perm in check_list:
+def check_permissions_bulk(users, sites, check_list):
+    """
+    Checks the check_list for every user on every site at once.  Returns the
+    set of (user_id, site_id) pairs where the user has all the permissions
+    through PermafrostRoles on the site, using a single query however many
+    users and sites there are.  Users and sites can be instances or pks;
+    superusers (given as instances) pass on every site.
+    """
+    users = list(users)
+    user_ids = {getattr(user, "pk", user) for user in users}
+    site_ids = {getattr(site, "pk", site) for site in sites}
+    superuser_ids = {user.pk for user in users if getattr(user, "is_superuser", False)}
+
+    if not check_list:
+        return {(user_id, site_id) for user_id in user_ids for site_id in site_ids}
+
+    passing = {(user_id, site_id) for user_id in superuser_ids for site_id in site_ids}
+
+    # Only the permissions being checked are read, "app_label." entries
+    # needing any permission of the app
+    query = Q()
+    for perm in set(check_list):
         app_label, codename = perm.split(".")
-        qry = {}
-        qry["content_type__app_label"] = app_label
         if codename:
-            qry["codename"] = codename
-
-        if user_permissions.filter(**qry):
-            has_permission = True
+            query |= Q(content_type__app_label=app_label, codename=codename)
         else:
-            return False
+            query |= Q(content_type__app_label=app_label)
+
+    user_groups_query = get_user_groups_query()
+    rows = (
+        Permission.objects.filter(
+            query,
+            **{user_groups_query + "__in": user_ids - superuser_ids},
+            group__permafrost_role__site__in=site_ids,
+        )
+        .values_list(
+            user_groups_query,
+            "group__permafrost_role__site",
+            "content_type__app_label",
+            "codename",
+        )
+        .order_by()
+        .distinct()
+    )
+
+    granted = {}
+    for user_id, site_id, app_label, codename in rows:
+        granted.setdefault((user_id, site_id), set()).add(
+            "%s.%s" % (app_label, codename)
+        )
+
+    passing.update(
+        pair
+        for pair, user_permissions in granted.items()
+        if permissions_granted(check_list, user_permissions)
+    )
+    return passing
+
+
+async def aget_request_user(request):
+    """
+    Returns request.user, loading it with request.auser() if it has not been
+    loaded yet, as the lazy request.user can not be evaluated in async code.
+    """
+    user = getattr(request, "user", None)
+    if user is None or (isinstance(user, LazyObject) and user._wrapped is empty):
+        user = request.user = await request.auser()
+    return user
+
+
+@instrumented("ahas_all_permissions")
+async def ahas_all_permissions(request, check_list=[]):
+    """
+    Async version of has_all_permissions, sharing its permission cache.
+    """
+    if not check_list:
+        return True
+
+    user = await aget_request_user(request)
+    if user.is_superuser:
+        return True
+
+    if not user.is_authenticated:
+        return False
+
+    user_permissions = await aget_site_group_permissions(
+        user, await aget_request_site(request)
+    )
 
-    return has_permission
+    return permissions_granted(check_list, user_permissions)
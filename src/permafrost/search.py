@@ -0,0 +1,119 @@
+"""
+In-memory search over the permissions exposed by PERMAFROST_CATEGORIES.
+
+The index is built from the category registry (which already has the
+permissions and their content types loaded) and kept in it, so searching
+does not touch the database and the index is rebuilt whenever the registry
+is cleared.
+"""
+
+import re
+from bisect import bisect_left
+
+from .models import category_registry, get_permission_content_type
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+# How much a matching token counts towards a permission's rank, by field
+FIELD_WEIGHTS = (
+    ("name", 4),
+    ("content_type_name", 3),
+    ("codename", 2),
+    ("app_label", 1),
+)
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class PermissionSearchIndex:
+    """
+    Token index over each permission's name, content type verbose name,
+    codename and app label.  Query tokens match index tokens by prefix; a
+    permission has to match every query token and results are ranked by the
+    weight of the fields that matched (exact tokens count double).
+    """
+
+    def __init__(self, permissions):
+        self.permissions = {}
+        self.tokens = {}  # token -> {pk: weight}
+
+        for permission in permissions:
+            self.permissions[permission.pk] = permission
+            content_type = get_permission_content_type(permission)
+            fields = {
+                "name": permission.name,
+                "content_type_name": content_type.name,
+                "codename": permission.codename,
+                "app_label": content_type.app_label,
+            }
+            for field, weight in FIELD_WEIGHTS:
+                for token in tokenize(fields[field]):
+                    postings = self.tokens.setdefault(token, {})
+                    postings[permission.pk] = max(
+                        postings.get(permission.pk, 0), weight
+                    )
+
+        self.sorted_tokens = sorted(self.tokens)
+
+    def match(self, query_token):
+        """
+        Returns {pk: score} for the permissions with a token starting with
+        query_token.
+        """
+        scores = {}
+        position = bisect_left(self.sorted_tokens, query_token)
+
+        while position < len(self.sorted_tokens):
+            token = self.sorted_tokens[position]
+            if not token.startswith(query_token):
+                break
+            multiplier = 2 if token == query_token else 1
+            for pk, weight in self.tokens[token].items():
+                scores[pk] = max(scores.get(pk, 0), weight * multiplier)
+            position += 1
+
+        return scores
+
+    def search(self, query="", exclude=()):
+        """
+        Returns the permissions matching the query, best match first, leaving
+        out any whose pk is in exclude.  An empty query returns everything.
+        """
+        scores = None
+
+        for query_token in tokenize(query):
+            matches = self.match(query_token)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {
+                    pk: scores[pk] + matches[pk] for pk in scores if pk in matches
+                }
+
+        if scores is None:
+            scores = dict.fromkeys(self.permissions, 0)
+
+        ranked = sorted(
+            (pk for pk in scores if pk not in exclude),
+            key=lambda pk: (-scores[pk], self.permissions[pk].name, pk),
+        )
+        return [self.permissions[pk] for pk in ranked]
+
+
+def get_permission_search_index():
+    """
+    The search index over every permission in PERMAFROST_CATEGORIES.
+    """
+
+    def build():
+        permissions = {}
+        for category in category_registry.categories:
+            for permission in category_registry.required(
+                category
+            ) + category_registry.optional(category):
+                permissions[permission.pk] = permission
+        return PermissionSearchIndex(permissions.values())
+
+    return category_registry.memoize("search_index", build)
@@ -0,0 +1,158 @@
+"""
+Resolving the current Site for Permafrost.
+
+The Site of a request is looked up by host name in an in-process map of every
+Site (loaded with one query and cleared when a Site is saved or deleted).  A
+host missing from the map is looked up in the database, as the Site may have
+been added by another process, before falling back to SITE_ID.
+PermafrostSiteMiddleware resolves it once per request and activates it so the
+backends use it instead of calling ``Site.objects.get_current()`` themselves.
+"""
+
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http.request import split_domain_port
+
+_active_site = ContextVar("permafrost_active_site", default=None)
+
+
+class SiteHostMap:
+    """
+    Maps host names (and ids) to Sites for the current process.
+    """
+
+    def __init__(self):
+        self.maps = None
+
+    def clear(self):
+        self.maps = None
+
+    def build(self, sites):
+        self.maps = (
+            {site.domain.lower(): site for site in sites},
+            {site.pk: site for site in sites},
+        )
+        return self.maps
+
+    def get_maps(self):
+        maps = self.maps  # A local copy as another thread may clear the map
+        if maps is None:
+            maps = self.build(list(Site.objects.all()))
+        return maps
+
+    async def aget_maps(self):
+        maps = self.maps
+        if maps is None:
+            maps = self.build([site async for site in Site.objects.all()])
+        return maps
+
+
+site_host_map = SiteHostMap()
+
+
+@receiver(post_save, sender=Site, dispatch_uid="permafrost_site_saved")
+@receiver(post_delete, sender=Site, dispatch_uid="permafrost_site_deleted")
+def clear_site_host_map(**kwargs):
+    site_host_map.clear()
+
+
+def get_hosts(request):
+    """
+    The request's host and its domain without the port, lower cased.
+    """
+    host = request.get_host().lower()
+    domain, port = split_domain_port(host)
+    return host, domain
+
+
+def get_hosts_query(host, domain):
+    return Site.objects.filter(Q(domain__iexact=host) | Q(domain__iexact=domain))
+
+
+def match_site(sites, host, domain):
+    """
+    The Site of host, or else of domain, from a mapping of domains to Sites.
+    """
+    return sites.get(host) or sites.get(domain)
+
+
+def resolve_site(request):
+    """
+    Returns the Site for the request's host (with or without the port),
+    or the SITE_ID Site if no Site has that domain.
+    """
+    host, domain = get_hosts(request)
+    hosts, ids = site_host_map.get_maps()
+    site = match_site(hosts, host, domain)
+
+    if site is None:
+        found = {s.domain.lower(): s for s in get_hosts_query(host, domain)}
+        site = match_site(found, host, domain)
+        if site is not None:
+            site_host_map.clear()  # Added by another process, reload the map
+        else:
+            site = ids.get(getattr(settings, "SITE_ID", None))
+
+    if site is None:
+        site = Site.objects.get_current()  # Raises the usual errors
+    return site
+
+
+async def aresolve_site(request):
+    host, domain = get_hosts(request)
+    hosts, ids = await site_host_map.aget_maps()
+    site = match_site(hosts, host, domain)
+
+    if site is None:
+        found = {s.domain.lower(): s async for s in get_hosts_query(host, domain)}
+        site = match_site(found, host, domain)
+        if site is not None:
+            site_host_map.clear()
+        else:
+            site = ids.get(getattr(settings, "SITE_ID", None))
+
+    if site is None:
+        site = await sync_to_async(Site.objects.get_current)()
+    return site
+
+
+def get_request_site(request):
+    """
+    Returns request.site, resolving and setting it when no middleware has.
+    """
+    site = getattr(request, "site", None)
+    if site is None:
+        site = request.site = resolve_site(request)
+    return site
+
+
+async def aget_request_site(request):
+    site = getattr(request, "site", None)
+    if site is None:
+        site = request.site = await aresolve_site(request)
+    return site
+
+
+def get_active_site():
+    """
+    The Site activated for the request being handled, or None.
+    """
+    return _active_site.get()
+
+
+def activate_site(site):
+    """
+    Makes the site the default for the Permafrost backends in the current
+    context.  Returns a token for deactivate_site.
+    """
+    return _active_site.set(site)
+
+
+def deactivate_site(token):
+    _active_site.reset(token)
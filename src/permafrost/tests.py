@@ -1,21 +1,73 @@
+import json
+import logging
+import os
+import socket
+import tempfile
+import time
+import timeit
+from asgiref.sync import iscoroutinefunction
+from io import StringIO
 from unittest import skipIf
+from unittest.mock import Mock, call, patch
 from django.forms.models import model_to_dict
-from django.test import TestCase, RequestFactory
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.core.cache import caches
+from django.core.management import call_command
 from django.contrib.sites.models import Site
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
 from django.db.utils import IntegrityError
-from django.db import transaction
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import Group, Permission
+from django.contrib.contenttypes.models import ContentType
 from django.test.client import Client
 from django.urls.base import resolve, reverse
+from django.http import HttpResponse
+from django.utils.functional import SimpleLazyObject
+from django.views.generic import View
 from .views import (
+    PermafrostAsyncSiteMixin,
+    PermafrostLogMixin,
+    PermafrostMixin,
+    PermafrostSiteMixin,
+    get_category_layout,
+    group_permission_categories,
     PermafrostRoleCreateView,
     PermafrostRoleManageView,
     PermafrostRoleUpdateView,
     PermafrostRoleListView,
+    PermafrostRoleUserListView,
+)
+from . import audit, effective
+from .audit import AuditBuffer, FileWriter
+from .cache import bump_generations, clear_user_cache, get_shared_generation
+from .deferred import defer, has_pending
+from .backends import (
+    PermafrostModelBackend,
+    filter_objects_for_user,
+    get_site_group_permissions,
+    get_site_permissions_queryset,
+)
+from .middleware import PermafrostSiteMiddleware
+from .sites import (
+    activate_site,
+    aget_request_site,
+    deactivate_site,
+    get_active_site,
+    site_host_map,
+)
+from .search import PermissionSearchIndex, get_permission_search_index
+from .instrumentation import CheckRecord, StatsdSink, permission_checked
+from .logs import JSONFormatter, log_denied
+from .permissions import (
+    PermafrostRESTPermission,
+    ahas_all_permissions,
+    check_permissions_bulk,
+    has_all_permissions,
 )
 from .forms import (
+    assemble_optiongroups_for_widget,
     PermafrostRoleCreateForm,
     PermafrostRoleUpdateForm,
     SelectPermafrostRoleTypeForm,
@@ -29,11 +81,17 @@ except ImportError:
     SKIP_DRF_TESTS = True
 
 from permafrost.models import (
+    PermafrostAuditEvent,
+    PermafrostEffectivePermission,
     PermafrostRole,
     get_current_site,
     CATEGORIES,
+    category_registry,
     get_all_perms_for_all_categories,
+    get_optional_by_category,
+    get_required_by_category,
     PERMAFROST_EXCLUDED_ROLES,
+    users_with_permission,
 )
 
 
@@ -69,6 +127,12 @@ class PermafrostRoleModelTest(TestCase):
             *("add_logentry", "admin", "logentry")
         )
 
+    def request(self, user, site):
+        request = RequestFactory().get("/")
+        request.user = user
+        request.site = site
+        return request
+
     def test_role_rename_updates_group(self):
         """
         Make sure renaming the PermafrostRole properly renames the Django Group model.
@@ -405,6 +469,226 @@ class PermafrostRoleModelTest(TestCase):
 
         self.assertListEqual(sorted(all_perm_names), sorted(category_perm_names))
 
+    def test_category_registry_resolves_all_categories_in_one_query(self):
+        category_registry.clear()
+
+        with self.assertNumQueries(1):
+            for category in CATEGORIES:
+                get_required_by_category(category)
+                get_optional_by_category(category)
+            get_all_perms_for_all_categories()
+
+        self.assertEqual(
+            category_registry.optional_ids("staff"),
+            {self.perm_change_permafrostrole.pk, 37},
+        )
+
+    def test_category_registry_is_cleared_when_permissions_change(self):
+        category_registry.required("staff")
+
+        self.perm_view_permafrostrole.name = "Can look at Role"
+        self.perm_view_permafrostrole.save()
+
+        self.assertEqual(
+            category_registry.required("staff")[0].name, "Can look at Role"
+        )
+
+    def test_permission_guards_do_not_query_categories(self):
+        role = PermafrostRole(name="Bobs Staff Group", category="staff")
+        role.save()
+        perm_add_permafrostrole = Permission.objects.get_by_natural_key(
+            *("add_permafrostrole", "permafrost", "permafrostrole")
+        )
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                role.all_perm_ids(),
+                {
+                    perm_add_permafrostrole.pk,
+                    self.perm_change_permafrostrole.pk,
+                    self.perm_view_permafrostrole.pk,
+                },
+            )
+
+        with self.assertNumQueries(1):  # One M2M insert for all allowed perms
+            role.permissions_add(
+                perm_add_permafrostrole,
+                self.perm_change_permafrostrole,
+                self.perm_delete_permafrostrole,
+            )
+
+        role.permissions_remove(
+            self.perm_change_permafrostrole, self.perm_view_permafrostrole
+        )
+        self.assertListEqual(
+            list(role.group.permissions.order_by("pk")),
+            [perm_add_permafrostrole, self.perm_view_permafrostrole],
+        )
+
+    def test_conform_group_only_writes_the_difference(self):
+        role = PermafrostRole.objects.get(slug="bobs-staff-group")
+        role.permissions_add(self.perm_change_permafrostrole)
+
+        role.description = "Only the description changed"
+        with CaptureQueriesContext(connection) as queries:
+            role.save()
+
+        writes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if "auth_group_permissions" in query["sql"]
+            and not query["sql"].startswith("SELECT")
+        ]
+        self.assertEqual(writes, [])
+
+        role.group.permissions.add(self.perm_add_logentry)  # Not allowed in staff
+        role.group.permissions.remove(self.perm_view_permafrostrole)  # Required
+
+        self.assertTrue(role.conform_group())
+        self.assertListEqual(
+            list(role.group.permissions.order_by("pk")),
+            [self.perm_change_permafrostrole, self.perm_view_permafrostrole],
+        )
+        self.assertFalse(role.conform_group())
+
+    def test_provision_sites_creates_roles_in_bulk(self):
+        roles = [
+            {"name": "Student", "category": "user"},
+            {"name": "Staff Member", "category": "staff", "locked": True},
+        ]
+
+        def provision(count):
+            sites = Site.objects.bulk_create(
+                [
+                    Site(domain="%s-%s.example.com" % (count, i), name="Site")
+                    for i in range(count)
+                ]
+            )
+            with CaptureQueriesContext(connection) as queries:
+                PermafrostRole.objects.provision_sites(sites, roles)
+            return sites, len(queries)
+
+        category_registry.build()
+        sites, small_count = provision(2)
+        sites, large_count = provision(6)
+        self.assertEqual(small_count, large_count)
+
+        role = PermafrostRole.objects.get(site=sites[-1], slug="staff-member")
+        self.assertTrue(role.locked)
+        self.assertEqual(role.group.name, "%s_staff_staff-member" % sites[-1].pk)
+        self.assertListEqual(
+            list(role.group.permissions.all()), [self.perm_view_permafrostrole]
+        )
+
+        # Running it again only creates what is missing
+        self.assertEqual(PermafrostRole.objects.provision_sites(sites, roles), [])
+        self.assertEqual(
+            [
+                role.name
+                for role in PermafrostRole.objects.provision_sites([self.site_1], roles)
+            ],
+            ["Staff Member"],
+        )
+
+    def test_add_and_remove_users_in_bulk(self):
+        staff_role = PermafrostRole.objects.get(slug="bobs-staff-group")
+        site_2_role = PermafrostRole.objects.get(slug="administrator")
+        assignments = [
+            (self.user, staff_role),
+            (self.staffuser.pk, staff_role),
+            (self.user, site_2_role),
+        ]
+
+        with self.assertNumQueries(1):
+            self.assertFalse(
+                has_all_permissions(
+                    self.request(self.user, self.site_1),
+                    ["permafrost.view_permafrostrole"],
+                )
+            )
+
+        with self.assertNumQueries(4):  # One insert per batch, plus the savepoint
+            PermafrostRole.objects.add_users(assignments, batch_size=2)
+
+        PermafrostRole.objects.add_users(assignments)  # Already members
+        self.assertListEqual(
+            list(staff_role.user_set().order_by("pk")), [self.user, self.staffuser]
+        )
+        self.assertListEqual(list(site_2_role.user_set()), [self.user])
+        self.assertTrue(
+            has_all_permissions(
+                self.request(self.user, self.site_1),
+                ["permafrost.view_permafrostrole"],
+            )
+        )
+
+        with self.assertNumQueries(3):  # One delete per batch, plus the savepoint
+            PermafrostRole.objects.remove_users(assignments[1:])
+
+        self.assertListEqual(list(staff_role.user_set()), [self.user])
+        self.assertListEqual(list(site_2_role.user_set()), [])
+
+    def test_roles_for_users_on_site(self):
+        student, councilor, administrator = PermafrostRole.objects.filter(
+            pk__in=[1, 2, 3]
+        ).order_by("pk")
+        student.users_add(self.user)
+        councilor.users_add(self.user, self.staffuser)
+        administrator.users_add(self.user)
+        users = [self.user, self.staffuser, self.administrationuser]
+
+        with self.assertNumQueries(2):
+            roles = PermafrostRole.objects.for_users(users, self.site_1)
+            for role_list in roles.values():
+                for role in role_list:
+                    list(p.content_type for p in role.group.permissions.all())
+
+        self.assertEqual(roles[self.user.pk], [councilor, student])
+        self.assertEqual(roles[self.staffuser.pk], [councilor])
+        self.assertEqual(roles[self.administrationuser.pk], [])
+        self.assertEqual(
+            PermafrostRole.objects.for_users([self.user], self.site_2),
+            {self.user.pk: [administrator]},
+        )
+
+    def test_roles_and_users_with_permission(self):
+        councilor, administrator, staff_role = PermafrostRole.objects.filter(
+            pk__in=[2, 3, 4]
+        ).order_by("pk")
+        staff_role.permissions_add(self.perm_view_permafrostrole)
+        administrator.users_add(self.user, self.staffuser)
+        staff_role.users_add(self.user)
+
+        with self.assertNumQueries(1):
+            roles = list(
+                PermafrostRole.objects.with_permission(
+                    "permafrost.view_permafrostrole", counts=True
+                ).order_by("pk")
+            )
+        self.assertEqual(roles, [councilor, administrator, staff_role])
+        self.assertEqual([role.user_count for role in roles], [0, 2, 1])
+
+        self.assertQuerySetEqual(
+            PermafrostRole.objects.with_permission(
+                self.perm_view_permafrostrole, site=self.site_1
+            ).order_by("pk"),
+            [councilor, staff_role],
+        )
+        self.assertQuerySetEqual(
+            PermafrostRole.objects.with_permission(
+                self.perm_change_permafrostrole.pk, site=self.site_1
+            ),
+            [],
+        )
+        self.assertQuerySetEqual(
+            users_with_permission("permafrost.view_permafrostrole").order_by("pk"),
+            [self.user, self.staffuser],
+        )
+        self.assertQuerySetEqual(
+            users_with_permission("permafrost.view_permafrostrole", site=self.site_1),
+            [self.user],
+        )
+
     def test_unable_to_delete_default_roles(self):
         role = PermafrostRole.objects.get(pk=3)
         role.delete()
@@ -724,6 +1008,23 @@ class PermafrostViewTests(TestCase):
             print("")
             raise
 
+    def test_update_form_selection_does_not_modify_shared_permissions(self):
+        self.pf_role.permissions_set(
+            Permission.objects.filter(codename__in=["add_permafrostrole"])
+        )
+        layout = get_category_layout("staff")
+
+        uri = reverse("permafrost:role-update", kwargs={"slug": "test-role"})
+        response = self.client.get(uri)
+
+        optional = response.context["permission_categories"]["permafrostrole"][
+            "optional"
+        ]
+        self.assertEqual([perm.selected for perm in optional], [True, False])
+        self.assertIs(get_category_layout("staff"), layout)
+        for permission in category_registry.optional("staff"):
+            self.assertFalse(hasattr(permission, "selected"))
+
     def test_role_detail_GET_returns_404_if_not_on_current_site(self):
         uri = reverse("permafrost:role-update", kwargs={"slug": "administrator"})
         response = self.client.get(uri)
@@ -946,6 +1247,185 @@ class PermafrostViewTests(TestCase):
             print("")
             raise
 
+    def test_modal_only_adds_permissions_of_the_roles_category(self):
+        role = PermafrostRole.objects.get(slug="bobs-staff-group")
+        change, delete = Permission.objects.filter(
+            content_type__app_label="permafrost",
+            codename__in=["change_permafrostrole", "delete_permafrostrole"],
+        ).order_by("codename")
+        uri = reverse(
+            "permafrost:custom-role-add-permissions",
+            kwargs={"slug": "bobs-staff-group"},
+        )
+
+        self.client.post(uri, {"permissions": [change.pk, delete.pk]})
+
+        permissions = role.group.permissions.all()
+        self.assertIn(change, permissions)
+        self.assertNotIn(delete, permissions)
+
+    def test_modal_search_matches_content_type_names(self):
+        uri = reverse(
+            "permafrost:custom-role-add-permissions",
+            kwargs={"slug": "bobs-staff-group"},
+        )
+        response = self.client.get(uri, {"q": "permafrost ro"})
+
+        self.assertTemplateUsed(response, "permafrost/includes/permissions_table.html")
+        self.assertContains(response, "Can delete Role")  # From administration
+
+    def test_role_user_list_pages_by_cursor(self):
+        users = get_user_model().objects.bulk_create(
+            [get_user_model()(username="member%s" % i) for i in range(5)]
+        )
+        self.pf_role.users_add(*users)
+        uri = reverse("permafrost:role-users", kwargs={"slug": self.pf_role.slug})
+
+        with patch.object(PermafrostRoleUserListView, "paginate_by", 3):
+            first = self.client.get(uri)
+            second = self.client.get(uri, {"after": first.context["next_cursor"]})
+
+        self.assertEqual(first.context["user_list"], users[:3])
+        self.assertEqual(first.context["next_cursor"], users[2].pk)
+        self.assertEqual(second.context["user_list"], users[3:])
+        self.assertIsNone(second.context["next_cursor"])
+        self.assertEqual(self.client.get(uri, {"after": "abc"}).status_code, 400)
+
+    def test_role_user_list_bulk_add_and_remove(self):
+        users = get_user_model().objects.bulk_create(
+            [get_user_model()(username="member%s" % i) for i in range(3)]
+        )
+        uri = reverse("permafrost:role-users", kwargs={"slug": self.pf_role.slug})
+        ids = ",".join(str(user.pk) for user in users)
+
+        response = self.client.post(uri, {"action": "add", "users": ids})
+        self.assertRedirects(response, uri)
+        self.assertEqual(list(self.pf_role.user_set().order_by("pk")), users)
+
+        self.client.post(uri, {"action": "remove", "users": [users[0].pk, users[1].pk]})
+        self.assertEqual(list(self.pf_role.user_set()), users[2:])
+
+    def test_role_user_export_streams_csv_and_json(self):
+        user = get_user_model().objects.create(username="member", email="m@x.com")
+        self.pf_role.users_add(user)
+        uri = reverse(
+            "permafrost:role-users-export", kwargs={"slug": self.pf_role.slug}
+        )
+
+        response = self.client.get(uri)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines(),
+            ["pk,username,email", "%s,member,m@x.com" % user.pk],
+        )
+
+        response = self.client.get(uri, {"format": "json"})
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            [{"pk": user.pk, "username": "member", "email": "m@x.com"}],
+        )
+
+    def test_user_roles_view_returns_roles_and_permissions(self):
+        user = get_user_model().objects.create(username="member")
+        role = PermafrostRole.objects.get(pk=4)
+        role.users_add(user)
+        role.permissions_add(Permission.objects.get(pk=40))
+
+        uri = reverse("permafrost:user-roles-detail", kwargs={"user_pk": user.pk})
+        response = self.client.get(uri, {"format": "json"})
+        result = response.json()["results"][0]
+
+        self.assertEqual(result["username"], "member")
+        self.assertEqual([r["slug"] for r in result["roles"]], ["bobs-staff-group"])
+        self.assertIn("permafrost.view_permafrostrole", result["permissions"])
+
+        response = self.client.get(reverse("permafrost:user-roles"))
+        self.assertTemplateUsed(response, "permafrost/permafrostrole_user_roles.html")
+        self.assertIn(
+            "member", [entry["username"] for entry in response.context["user_roles"]]
+        )
+        self.assertEqual(
+            self.client.get(
+                reverse("permafrost:user-roles-detail", kwargs={"user_pk": "x"})
+            ).status_code,
+            404,
+        )
+
+    def test_user_roles_view_hides_users_without_a_role_on_the_site(self):
+        user = get_user_model().objects.create(username="member")
+        PermafrostRole.objects.get(pk=3).users_add(user)  # Role on site 2
+        uri = reverse("permafrost:user-roles-detail", kwargs={"user_pk": user.pk})
+
+        self.assertEqual(self.client.get(uri).status_code, 404)
+
+        role = PermafrostRole.objects.get(pk=4)
+        role.users_add(user)
+        PermafrostRole.objects.filter(pk=4).update(deleted=True)
+        self.assertEqual(self.client.get(uri).status_code, 404)
+
+    def test_permission_holders_view(self):
+        user = get_user_model().objects.create(username="member")
+        role = PermafrostRole.objects.get(pk=4)
+        role.users_add(user)
+        role.permissions_add(Permission.objects.get(pk=40))
+        uri = reverse(
+            "permafrost:permission-holders",
+            kwargs={"permission": "permafrost.view_permafrostrole"},
+        )
+
+        data = self.client.get(uri, {"format": "json", "counts": "1"}).json()
+        self.assertEqual(data["roles"][0]["slug"], "bobs-staff-group")
+        self.assertEqual(data["roles"][0]["user_count"], 1)
+        self.assertEqual(data["users"], [{"pk": user.pk, "username": "member"}])
+        self.assertEqual(data["user_count"], 1)
+        self.assertIsNone(data["next"])
+
+        response = self.client.get(uri)
+        self.assertTemplateUsed(
+            response, "permafrost/permafrostrole_permission_holders.html"
+        )
+        self.assertContains(response, "member")
+
+
+class PermafrostSearchIndexTests(TestCase):
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.index = PermissionSearchIndex(
+            Permission.objects.select_related("content_type")
+        )
+
+    def search(self, query, **kwargs):
+        return [perm.codename for perm in self.index.search(query, **kwargs)]
+
+    def test_prefix_and_token_matching(self):
+        self.assertEqual(
+            self.search("log ent"),
+            ["add_logentry", "change_logentry", "delete_logentry", "view_logentry"],
+        )
+        self.assertEqual(self.search("chan permafrostr"), ["change_permafrostrole"])
+        self.assertEqual(self.search("nothing here"), [])
+
+    def test_results_are_ranked_and_excludable(self):
+        self.assertEqual(self.search("delete session")[0], "delete_session")
+
+        view_role = Permission.objects.get(codename="view_permafrostrole")
+        self.assertNotIn(
+            "view_permafrostrole", self.search("role", exclude={view_role.pk})
+        )
+
+    def test_category_index_is_kept_in_the_registry(self):
+        index = get_permission_search_index()
+        self.assertIs(get_permission_search_index(), index)
+
+        with self.assertNumQueries(0):
+            results = index.search("role")
+        self.assertEqual(len(results), 4)
+
+        category_registry.clear()
+        self.assertIsNot(get_permission_search_index(), index)
+
 
 # @tag('admin_tests')
 class PermafrostFormClassTests(TestCase):
@@ -999,6 +1479,27 @@ class PermafrostFormClassTests(TestCase):
         self.assertEqual(form["description"].value(), self.pf_role.description)
         self.assertEqual(form["deleted"].value(), self.pf_role.deleted)
 
+    def test_permission_grouping_does_not_query_content_types(self):
+        permissions = list(
+            Permission.objects.select_related("content_type").filter(
+                content_type__app_label__in=["permafrost", "auth"]
+            )
+        )
+        ContentType.objects.clear_cache()
+
+        with self.assertNumQueries(0):
+            optgroups = dict(assemble_optiongroups_for_widget(permissions))
+            categories = group_permission_categories([], permissions, [])
+
+        self.assertIn("Permafrost Role", optgroups)
+        self.assertEqual(categories["permafrostrole"]["name"], "Permafrost Role")
+
+        # Without the join, each ContentType is looked up once and then cached
+        permissions = list(Permission.objects.filter(content_type__model="group"))
+        with self.assertNumQueries(1):
+            group_permission_categories([], permissions, [])
+            assemble_optiongroups_for_widget(permissions)
+
 
 class PermafrostSiteMixinTests(TestCase):
 
@@ -1053,3 +1554,1047 @@ class PermafrostSiteMixinTests(TestCase):
         response = PermafrostRoleListView.as_view()(request)
 
         self.assertEqual(response.status_code, 200)
+
+    def test_has_all_permissions_checks_the_list_in_one_query(self):
+        request = self.factory.get("/manage/")
+        request.user = self.user
+        request.site = Site.objects.get(pk=2)
+
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Site 2 Administrator
+        check_list = [
+            "permafrost.add_permafrostrole",
+            "permafrost.change_permafrostrole",
+            "permafrost.view_permafrostrole",
+        ]
+
+        with self.assertNumQueries(1):
+            self.assertTrue(has_all_permissions(request, check_list))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(has_all_permissions(request, ["permafrost."]))
+            self.assertFalse(has_all_permissions(request, ["admin."]))
+            self.assertFalse(
+                has_all_permissions(
+                    request, check_list + ["permafrost.delete_permafrostrole"]
+                )
+            )
+
+    def test_check_permissions_bulk(self):
+        staff = get_user_model().objects.create(username="staff")
+        superuser = get_user_model().objects.get(pk=1)
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Site 2 Administrator
+        PermafrostRole.objects.get(pk=4).users_add(staff)  # Site 1 Bob's Staff
+        PermafrostRole.objects.get(pk=4).permissions_add(Permission.objects.get(pk=40))
+        users = [self.user, staff, superuser]
+        sites = [1, 2]
+
+        with self.assertNumQueries(1):
+            passing = check_permissions_bulk(
+                users, sites, ["permafrost.view_permafrostrole"]
+            )
+        self.assertEqual(
+            passing,
+            {(self.user.pk, 2), (staff.pk, 1), (1, 1), (1, 2)},
+        )
+
+        self.assertEqual(
+            check_permissions_bulk(
+                users,
+                sites,
+                ["permafrost.view_permafrostrole", "permafrost.change_permafrostrole"],
+            ),
+            {(self.user.pk, 2), (1, 1), (1, 2)},
+        )
+        self.assertEqual(
+            check_permissions_bulk([self.user.pk, staff.pk], sites, ["permafrost."]),
+            {(self.user.pk, 2), (staff.pk, 1)},
+        )
+
+
+@override_settings(ALLOWED_HOSTS=["*"])
+class PermafrostSiteMiddlewareTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = get_user_model().objects.create(username="jacob")
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Site 2 Administrator
+        site_host_map.clear()
+
+    def handle(self, host, view):
+        request = self.factory.get("/", HTTP_HOST=host)
+        request.user = self.user
+        return PermafrostSiteMiddleware(view)(request)
+
+    def test_resolves_site_from_host_once(self):
+        def view(request):
+            self.assertIs(get_active_site(), request.site)
+            return request.site
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.handle("thatsite.com:8000", view).pk, 2)
+            self.assertEqual(self.handle("THATSITE.COM", view).pk, 2)
+        with self.assertNumQueries(1):  # Looked up in case it is a new Site
+            self.assertEqual(self.handle("unknown.com", view).pk, 1)  # SITE_ID
+
+        self.assertIsNone(get_active_site())
+
+        Site.objects.create(domain="newsite.com", name="New Site")
+        self.assertEqual(self.handle("newsite.com", view).domain, "newsite.com")
+
+    def test_finds_sites_added_by_other_processes(self):
+        def view(request):
+            return request.site
+
+        self.assertEqual(self.handle("newsite.com", view).pk, 1)
+
+        Site.objects.bulk_create([Site(domain="NewSite.com", name="New Site")])
+        self.assertEqual(self.handle("newsite.com:8000", view).domain, "NewSite.com")
+        with self.assertNumQueries(1):  # The map was reloaded with the new Site
+            self.assertEqual(self.handle("newsite.com", view).domain, "NewSite.com")
+
+    def test_backend_and_checks_use_the_request_site(self):
+        backend = PermafrostModelBackend()
+
+        def view(request):
+            return (
+                backend.has_perm(self.user, "permafrost.view_permafrostrole"),
+                has_all_permissions(request, ["permafrost.view_permafrostrole"]),
+                "permafrost.view_permafrostrole" in request.permafrost_perms,
+            )
+
+        self.assertEqual(self.handle("thatsite.com", view), (True, True, True))
+        self.assertEqual(self.handle("thissite.com", view), (False, False, False))
+
+    def test_permission_set_is_loaded_lazily(self):
+        def view(request):
+            with self.assertNumQueries(0):
+                perms = request.permafrost_perms
+            with self.assertNumQueries(1):
+                self.assertIn("permafrost.view_permafrostrole", perms)
+            return perms
+
+        self.handle("thatsite.com", view)
+
+    async def test_async_requests_stay_async(self):
+        async def view(request):
+            self.assertIs(get_active_site(), request.site)
+            return request.site, await request.apermafrost_perms()
+
+        middleware = PermafrostSiteMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+
+        request = self.factory.get("/", HTTP_HOST="thatsite.com")
+        request.user = self.user
+        # A sync query here would raise SynchronousOnlyOperation
+        site, perms = await middleware(request)
+        self.assertEqual(site.pk, 2)
+        self.assertIn("permafrost.view_permafrostrole", perms)
+        self.assertIsNone(get_active_site())
+
+    async def test_async_requests_find_sites_added_by_other_processes(self):
+        def request():
+            return self.factory.get("/", HTTP_HOST="newsite.com")
+
+        self.assertEqual((await aget_request_site(request())).pk, 1)
+
+        await Site.objects.abulk_create([Site(domain="newsite.com", name="New")])
+        site = await aget_request_site(request())
+        self.assertEqual(site.domain, "newsite.com")
+
+
+class PermafrostAsyncTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = get_user_model().objects.create(username="jacob")
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Site 2 Administrator
+        self.site_1 = Site.objects.get(pk=1)
+        self.site_2 = Site.objects.get(pk=2)
+
+    def request(self, site=None):
+        request = self.factory.get("/")
+        request.user = self.user
+        if site is not None:
+            request.site = site
+        return request
+
+    async def test_ahas_all_permissions_shares_the_sync_cache(self):
+        request = self.request(self.site_2)
+
+        self.assertTrue(
+            await ahas_all_permissions(request, ["permafrost.view_permafrostrole"])
+        )
+        self.assertFalse(
+            await ahas_all_permissions(request, ["permafrost.delete_permafrostrole"])
+        )
+        self.assertFalse(
+            await ahas_all_permissions(
+                self.request(), ["permafrost.view_permafrostrole"]
+            )  # SITE_ID
+        )
+
+        # A sync query here would raise SynchronousOnlyOperation
+        self.assertTrue(
+            has_all_permissions(request, ["permafrost.view_permafrostrole"])
+        )
+
+    async def test_ahas_all_permissions_loads_a_lazy_user(self):
+        request = self.request(self.site_2)
+        request.user = SimpleLazyObject(lambda: self.fail("Sync user access"))
+
+        async def auser():
+            return self.user
+
+        request.auser = auser
+        self.assertTrue(
+            await ahas_all_permissions(request, ["permafrost.view_permafrostrole"])
+        )
+        self.assertEqual(request.user, self.user)
+
+    async def test_backend_ahas_perm(self):
+        backend = PermafrostModelBackend()
+        self.assertFalse(
+            await backend.ahas_perm(self.user, "permafrost.view_permafrostrole")
+        )
+
+        token = activate_site(self.site_2)
+        try:
+            self.assertTrue(
+                await backend.ahas_perm(self.user, "permafrost.view_permafrostrole")
+            )
+        finally:
+            deactivate_site(token)
+
+        self.assertTrue(
+            "permafrost.view_permafrostrole"
+            in await backend.aget_all_permissions(self.user, site=self.site_2)
+        )
+
+    async def test_async_site_mixin(self):
+        class AsyncView(PermafrostAsyncSiteMixin, View):
+            permission_required = ["permafrost.view_permafrostrole"]
+
+            async def get(self, request):
+                return HttpResponse("ok")
+
+        response = await AsyncView.as_view()(self.request(self.site_2))
+        self.assertEqual(response.content, b"ok")
+
+        with self.assertRaises(PermissionDenied):
+            await AsyncView.as_view()(self.request(self.site_1))
+
+    async def test_async_site_mixin_logs_denied_checks(self):
+        class AsyncView(PermafrostLogMixin, PermafrostAsyncSiteMixin, View):
+            permission_required = ["permafrost.view_permafrostrole"]
+
+            async def get(self, request):
+                return HttpResponse("ok")
+
+        with self.assertLogs("permafrost", "INFO") as logs:
+            with self.assertRaises(PermissionDenied):
+                await AsyncView.as_view()(self.request(self.site_1))
+
+        data = json.loads(JSONFormatter().format(logs.records[0]))
+        self.assertEqual(data["user_permissions"], [])
+
+
+class PermafrostBackendCacheTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.backend = PermafrostModelBackend()
+        self.user = get_user_model().objects.create(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        self.site_1 = Site.objects.get(pk=1)
+        self.site_2 = Site.objects.get(pk=2)
+
+    def test_repeated_checks_are_served_from_cache(self):
+        PermafrostRole.objects.get(pk=4).users_add(self.user)
+
+        self.assertTrue(
+            self.backend.has_perm(self.user, "permafrost.view_permafrostrole")
+        )
+
+        with self.assertNumQueries(0):
+            self.assertTrue(
+                self.backend.has_perm(self.user, "permafrost.view_permafrostrole")
+            )
+            self.assertFalse(
+                self.backend.has_perm(self.user, "permafrost.add_permafrostrole")
+            )
+
+    def test_cache_is_split_by_site(self):
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Site 2 Administrator
+
+        self.assertEqual(
+            self.backend.get_group_permissions(self.user, site=self.site_1), set()
+        )
+        self.assertIn(
+            "permafrost.add_permafrostrole",
+            self.backend.get_group_permissions(self.user, site=self.site_2),
+        )
+
+    def test_superuser_permissions_are_cached_apart_from_role_permissions(self):
+        self.user.is_superuser = True
+        self.user.save()
+        all_perms = Permission.objects.count()
+
+        self.assertEqual(get_site_group_permissions(self.user, self.site_1), set())
+        self.assertEqual(
+            len(self.backend.get_group_permissions(self.user, site=self.site_1)),
+            all_perms,
+        )
+        self.assertEqual(get_site_group_permissions(self.user, self.site_1), set())
+
+    def test_role_changes_clear_the_cache(self):
+        role = PermafrostRole.objects.get(pk=4)
+
+        self.assertFalse(
+            self.backend.has_perm(self.user, "permafrost.view_permafrostrole")
+        )
+
+        role.users_add(self.user)
+        self.assertTrue(
+            self.backend.has_perm(self.user, "permafrost.view_permafrostrole")
+        )
+        self.assertFalse(
+            self.backend.has_perm(self.user, "permafrost.change_permafrostrole")
+        )
+
+        role.permissions_set(
+            Permission.objects.filter(codename__in=["change_permafrostrole"])
+        )
+        self.assertTrue(
+            self.backend.has_perm(self.user, "permafrost.change_permafrostrole")
+        )
+
+        role.users_remove(self.user)
+        self.assertFalse(
+            self.backend.has_perm(self.user, "permafrost.view_permafrostrole")
+        )
+
+
+class PermafrostObjectPermissionTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.backend = PermafrostModelBackend()
+        self.user = get_user_model().objects.create(username="jacob")
+        self.staff_role = PermafrostRole.objects.get(pk=4)  # Site 1
+        self.staff_role.users_add(self.user)
+        self.change_role = Permission.objects.get(pk=38)
+        self.student, self.councilor = PermafrostRole.objects.filter(
+            pk__in=[1, 2]
+        ).order_by("pk")
+        self.staff_role.object_permissions_add(self.councilor, self.change_role)
+
+    @override_settings(PERMAFROST_OBJECT_PERMISSIONS=True)
+    def test_object_grants_are_checked_from_one_query(self):
+        perm = "permafrost.change_permafrostrole"
+        Site.objects.get_current()  # Cached, like in a real request
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.backend.has_perm(self.user, perm, self.councilor))
+            self.assertFalse(self.backend.has_perm(self.user, perm, self.student))
+            self.assertFalse(
+                self.backend.has_perm(
+                    self.user, "permafrost.view_permafrostrole", self.councilor
+                )
+            )
+
+        self.assertFalse(
+            self.backend.get_object_permissions(
+                self.user, self.councilor, site=Site.objects.get(pk=2)
+            )
+        )
+
+        self.staff_role.object_permissions_remove(self.councilor, self.change_role)
+        self.assertFalse(self.backend.has_perm(self.user, perm, self.councilor))
+
+    @override_settings(PERMAFROST_OBJECT_PERMISSIONS=True)
+    async def test_async_checks_see_object_grants(self):
+        perm = "permafrost.change_permafrostrole"
+
+        # A sync query here would raise SynchronousOnlyOperation
+        self.assertTrue(await self.backend.ahas_perm(self.user, perm, self.councilor))
+        self.assertFalse(await self.backend.ahas_perm(self.user, perm, self.student))
+        self.assertEqual(
+            await self.backend.aget_all_permissions(self.user, self.councilor),
+            self.backend.get_object_permissions(self.user, self.councilor, site=1),
+        )  # From the shared cache
+
+    def test_object_grants_are_opt_in(self):
+        self.assertFalse(
+            self.backend.has_perm(
+                self.user, "permafrost.change_permafrostrole", self.councilor
+            )
+        )
+
+    def test_filter_objects_for_user(self):
+        roles = PermafrostRole.objects.all()
+        perm = "permafrost.change_permafrostrole"
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(filter_objects_for_user(self.user, perm, roles, site=1)),
+                [self.councilor],
+            )
+
+        self.assertFalse(filter_objects_for_user(self.user, perm, roles, site=2))
+        self.assertFalse(
+            filter_objects_for_user(
+                self.user, "permafrost.view_permafrostrole", roles, site=1
+            )
+        )
+        self.assertEqual(
+            filter_objects_for_user(
+                get_user_model().objects.get(pk=1), perm, roles, site=1
+            ).count(),
+            roles.count(),
+        )
+
+
+@override_settings(PERMAFROST_EFFECTIVE_PERMISSIONS=True)
+class PermafrostEffectivePermissionTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.backend = PermafrostModelBackend()
+        self.user = get_user_model().objects.create(username="jacob")
+        self.staff = get_user_model().objects.create(username="staff")
+        self.administrator = PermafrostRole.objects.get(pk=3)  # Site 2
+        self.staff_role = PermafrostRole.objects.get(pk=4)  # Site 1
+        with self.captureOnCommitCallbacks(execute=True):
+            effective.rebuild()
+
+    def assertTableIsCurrent(self):
+        self.assertEqual(
+            set(
+                PermafrostEffectivePermission.objects.values_list(
+                    "user_id", "site_id", "permission_id"
+                )
+            ),
+            set(effective.get_granted_rows()),
+        )
+
+    def test_membership_and_permission_changes_update_the_table(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.administrator.users_add(self.user)
+            self.staff_role.users_add(self.user, self.staff)
+        self.assertTableIsCurrent()
+        self.assertTrue(
+            PermafrostEffectivePermission.objects.filter(
+                user=self.user, site_id=2, permission_id=38
+            ).exists()
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff_role.permissions_add(Permission.objects.get(pk=40))
+            self.administrator.permissions_remove(Permission.objects.get(pk=38))
+        self.assertTableIsCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff.groups.clear()
+            self.staff_role.permissions_clear()
+        self.assertTableIsCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.administrator.users_remove(self.user)
+        self.assertTableIsCurrent()
+
+    def test_site_generation_is_bumped_after_the_table_is_written(self):
+        snapshots = []
+
+        def snapshot(site_ids):
+            if 1 in site_ids:
+                snapshots.append(
+                    set(
+                        PermafrostEffectivePermission.objects.filter(
+                            user=self.user, site_id=1
+                        ).values_list("permission_id", flat=True)
+                    )
+                )
+            return bump_generations(site_ids)
+
+        with patch("permafrost.cache.bump_generations", side_effect=snapshot):
+            with self.captureOnCommitCallbacks(execute=True):
+                PermafrostRole.objects.add_users([(self.user, self.staff_role)])
+
+        self.assertTrue(snapshots[-1])  # The last bump saw the written rows
+        self.assertEqual(
+            snapshots[-1],
+            set(
+                PermafrostEffectivePermission.objects.filter(
+                    user=self.user, site_id=1
+                ).values_list("permission_id", flat=True)
+            ),
+        )
+
+    def test_changes_are_applied_once_on_commit(self):
+        with patch.object(effective, "recompute") as recompute:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.staff_role.users_add(self.user)
+                self.staff_role.users_add(self.staff)
+                self.administrator.users_add(self.user)
+
+                # Until then checks on the changed sites skip the table
+                self.assertTrue(effective.is_pending(1))
+                queryset = get_site_permissions_queryset(self.user, 1)
+                self.assertNotIn(
+                    "permafrost_permafrosteffectivepermission", str(queryset.query)
+                )
+                recompute.assert_not_called()
+
+            self.assertEqual(len(callbacks), 1)
+            callbacks[0]()
+
+        self.assertFalse(effective.is_pending(1))
+        recompute.assert_has_calls(
+            [
+                call({self.user.pk, self.staff.pk}, [1], None),
+                call({self.user.pk}, [2], None),
+            ],
+            any_order=True,
+        )
+        self.assertEqual(recompute.call_count, 2)
+
+    def test_role_updates_recompute_the_old_and_new_site(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff_role.users_add(self.user)
+
+        with patch.object(effective, "recompute") as recompute:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.staff_role.description = "Renamed"
+                self.staff_role.save()
+            recompute.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.staff_role.site = Site.objects.get(pk=2)
+                self.staff_role.save()
+            recompute.assert_has_calls(
+                [call({self.user.pk}, [1], None), call({self.user.pk}, [2], None)],
+                any_order=True,
+            )
+
+            recompute.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.staff_role.deleted = True
+                self.staff_role.save()
+            recompute.assert_called_once_with({self.user.pk}, [2], None)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff_role.permissions_add(Permission.objects.get(pk=40))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.staff_role.site = Site.objects.get(pk=1)
+            self.staff_role.save()
+        self.assertTableIsCurrent()
+
+    def test_bulk_apis_and_role_deletes_update_the_table(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            role = PermafrostRole.objects.create(
+                name="Temp", category="staff", site=Site.objects.get(pk=1)
+            )
+            PermafrostRole.objects.add_users([(self.user, role), (self.staff, role)])
+        self.assertTableIsCurrent()
+        self.assertTrue(
+            PermafrostEffectivePermission.objects.filter(user=self.user).exists()
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PermafrostRole.objects.remove_users([(self.staff, role)])
+        self.assertTableIsCurrent()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            role.delete()
+        self.assertTableIsCurrent()
+        self.assertFalse(
+            PermafrostEffectivePermission.objects.filter(user=self.user).exists()
+        )
+
+    def test_checks_read_the_table(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.administrator.users_add(self.user)
+
+        queryset = get_site_permissions_queryset(self.user, 2)
+        self.assertIn("permafrost_permafrosteffectivepermission", str(queryset.query))
+        self.assertNotIn("auth_user_groups", str(queryset.query))
+        self.assertTrue(
+            self.backend.get_group_permissions(self.user, site=2)
+            >= {"permafrost.change_permafrostrole", "permafrost.view_permafrostrole"}
+        )
+
+        # Rows written behind the signals' back are what the checks see
+        PermafrostEffectivePermission.objects.filter(user=self.user).delete()
+        clear_user_cache(self.user)
+        self.assertEqual(self.backend.get_group_permissions(self.user, site=2), set())
+
+        out = StringIO()
+        call_command("permrebuild", stdout=out)
+        self.assertIn("effective permissions", out.getvalue())
+        clear_user_cache(self.user)
+        self.assertIn(
+            "permafrost.view_permafrostrole",
+            self.backend.get_group_permissions(self.user, site=2),
+        )
+
+
+@override_settings(PERMAFROST_CACHE="default")
+class PermafrostSharedCacheTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        caches["default"].clear()
+        self.backend = PermafrostModelBackend()
+        self.user = get_user_model().objects.create(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        self.role = PermafrostRole.objects.get(pk=4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.role.users_add(self.user)
+
+    def fresh_user(self):
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def perm(self, codename):
+        return Permission.objects.get(
+            codename=codename, content_type__app_label="permafrost"
+        )
+
+    def test_new_user_objects_are_served_from_shared_cache(self):
+        self.assertIn(
+            "permafrost.view_permafrostrole",
+            self.backend.get_group_permissions(self.fresh_user()),
+        )
+
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertIn(
+                "permafrost.view_permafrostrole",
+                self.backend.get_group_permissions(user),
+            )
+
+    def test_role_changes_bump_the_site_generation(self):
+        self.backend.get_group_permissions(self.fresh_user())
+
+        self.role.permissions_add(self.perm("change_permafrostrole"))
+        self.assertIn(
+            "permafrost.change_permafrostrole",
+            self.backend.get_group_permissions(self.fresh_user()),
+        )
+
+        self.role.users_clear()
+        self.assertEqual(self.backend.get_group_permissions(self.fresh_user()), set())
+
+    def test_shared_generation_is_bumped_on_commit(self):
+        shared = caches["default"]
+        generation = get_shared_generation(shared, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.role.users_remove(self.user)
+            self.role.permissions_add(self.perm("change_permafrostrole"))
+            self.assertEqual(get_shared_generation(shared, 1), generation)
+            self.assertEqual(
+                self.backend.get_group_permissions(self.fresh_user()), set()
+            )
+
+        self.assertEqual(get_shared_generation(shared, 1), generation + 1)
+
+
+class PermafrostDeferredTests(TestCase):
+    def test_rolled_back_work_is_not_applied(self):
+        handler = Mock()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    defer(handler, list).append("rolled back")
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            defer(handler, list).append("committed")
+
+        handler.assert_called_once_with(["committed"])
+
+    def test_work_is_applied_once_per_transaction(self):
+        handler = Mock()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            for key in (1, 2, 1):
+                defer(handler).add(key)
+            self.assertTrue(has_pending(handler, 2))
+
+        self.assertEqual(len(callbacks), 1)
+        handler.assert_called_once_with({1, 2})
+        self.assertFalse(has_pending(handler, 2))
+
+    def test_work_of_a_rolled_back_savepoint_is_dropped(self):
+        handler = Mock()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            defer(handler, list).append("before")
+            try:
+                with transaction.atomic():
+                    defer(handler, list).append("rolled back")
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertFalse(has_pending(handler, "rolled back"))
+
+            with transaction.atomic():
+                defer(handler, list).append("released")
+
+        handler.assert_has_calls([call(["before"]), call(["released"])])
+        self.assertEqual(handler.call_count, 2)
+
+
+class PermafrostRESTPermissionTests(SimpleTestCase):
+
+    class View:
+        permission_required = ("permafrost.view_permafrostrole",)
+        permission_required_post = "permafrost.add_permafrostrole"
+
+    class User:
+        def __init__(self, perms):
+            self.perms = perms
+
+        def get_all_permissions(self):
+            return self.perms
+
+    def check(self, perms, method="GET"):
+        request = RequestFactory().generic(method, "/")
+        request.user = self.User(perms)
+        return PermafrostRESTPermission().has_permission(request, self.View())
+
+    def test_method_permissions_are_merged(self):
+        self.assertTrue(self.check({"permafrost.view_permafrostrole"}))
+        self.assertFalse(self.check({"permafrost.view_permafrostrole"}, "POST"))
+        self.assertTrue(
+            self.check(
+                {"permafrost.view_permafrostrole", "permafrost.add_permafrostrole"},
+                "POST",
+            )
+        )
+
+    def test_cost_stays_flat_as_user_perms_grow(self):
+        """
+        Micro-benchmark: checking a user with 10,000 perms should cost about
+        the same as checking one with 10.
+        """
+
+        def best_time(count):
+            perms = {"app.perm_%s" % i for i in range(count)}
+            perms.add("permafrost.view_permafrostrole")
+            request = RequestFactory().get("/")
+            request.user = self.User(perms)
+            permission, view = PermafrostRESTPermission(), self.View()
+            return min(
+                timeit.repeat(
+                    lambda: permission.has_permission(request, view),
+                    number=2000,
+                    repeat=5,
+                )
+            )
+
+        small, large = best_time(10), best_time(10000)
+
+        self.assertLess(large, small * 3)
+
+
+class PermafrostBenchmarkTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def test_permbench_reports_timings_and_query_counts(self):
+        out = StringIO()
+        call_command("permbench", sites=2, roles=3, users=4, iterations=2, stdout=out)
+        data = json.loads(out.getvalue())
+
+        self.assertEqual(data["parameters"]["sites"], 2)
+        results = {result["name"]: result for result in data["results"]}
+        self.assertEqual(
+            results["backend.has_perm (same request)"]["queries_per_call"], 0
+        )
+        self.assertGreater(
+            results["has_all_permissions (new request)"]["queries_per_call"], 0
+        )
+        self.assertIn("mean_ms", results["PermafrostRoleUpdateView GET"])
+        self.assertFalse(Site.objects.filter(domain__startswith="bench-").exists())
+
+
+@override_settings(PERMAFROST_INSTRUMENTATION=True)
+class PermafrostInstrumentationTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        PermafrostRole.objects.get(pk=4).users_add(self.user)
+
+        self.records = []
+        permission_checked.connect(self.receive)
+        self.addCleanup(permission_checked.disconnect, self.receive)
+
+    def receive(self, record, **kwargs):
+        self.records.append(record.as_dict())
+
+    def test_checks_report_queries_and_cache_use(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        request.site = Site.objects.get(pk=1)
+
+        has_all_permissions(request, ["permafrost.view_permafrostrole"])
+        has_all_permissions(request, ["permafrost.add_permafrostrole"])
+        PermafrostModelBackend().has_perm(self.user, "permafrost.view_permafrostrole")
+
+        self.assertEqual(
+            [(record["name"], record["result"]) for record in self.records],
+            [
+                ("has_all_permissions", True),
+                ("has_all_permissions", False),
+                ("backend.has_perm", True),
+            ],
+        )
+        self.assertEqual(self.records[0]["queries"], 1)
+        self.assertEqual(self.records[0]["cache_misses"], 1)
+        self.assertEqual(self.records[1]["queries"], 0)
+        self.assertEqual(self.records[1]["cache_hits"], 1)
+        self.assertGreater(self.records[2]["queries"], 0)  # The user's own perms
+
+    def test_statsd_sink_sends_metrics(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+
+        sink = StatsdSink(port=server.getsockname()[1])
+        record = CheckRecord("has_all_permissions")
+        record.result = False
+        record.queries = 2
+        sink(record)
+
+        metrics = server.recv(4096).decode().split("\n")
+        self.assertIn("permafrost.has_all_permissions.queries:2|c", metrics)
+        self.assertIn("permafrost.has_all_permissions.denied:1|c", metrics)
+
+    @override_settings(PERMAFROST_INSTRUMENTATION=False)
+    def test_disabled_instrumentation_records_nothing(self):
+        PermafrostModelBackend().has_perm(self.user, "permafrost.view_permafrostrole")
+        self.assertEqual(self.records, [])
+
+
+@override_settings(
+    PERMAFROST_AUDIT=True,
+    PERMAFROST_AUDIT_FLUSH_INTERVAL=3600,  # Flushed by the tests themselves
+)
+class PermafrostAuditTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        self.role = PermafrostRole.objects.get(pk=4)  # Site 1
+
+    def actions(self):
+        return list(
+            PermafrostAuditEvent.objects.order_by("pk").values_list(
+                "action", "role_id", "site_id"
+            )
+        )
+
+    def test_role_changes_are_buffered_until_flushed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.role.users_add(self.user)
+            self.role.permissions_add(Permission.objects.get(pk=40))
+            PermafrostRole.objects.remove_users([(self.user, self.role)])
+
+        self.assertEqual(PermafrostAuditEvent.objects.count(), 0)
+        with self.assertNumQueries(1):
+            audit.flush()
+
+        self.assertEqual(
+            self.actions(),
+            [
+                ("users_added", 4, 1),
+                ("permissions_added", 4, 1),
+                ("users_removed", 4, 1),
+            ],
+        )
+        self.assertEqual(
+            PermafrostAuditEvent.objects.order_by("pk").first().details,
+            {"users": [self.user.pk]},
+        )
+
+    def test_rolled_back_changes_are_not_recorded(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.role.save()
+            try:
+                with transaction.atomic():
+                    self.role.users_add(self.user)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+
+        audit.flush()
+        self.assertEqual(self.actions(), [("role_updated", 4, 1)])
+
+    def test_denied_checks_are_recorded_with_the_missing_permissions(self):
+        request = RequestFactory().get("/manage/")
+        request.user = self.user
+        request.site = Site.objects.get(pk=2)
+        self.assertRaises(PermissionDenied, PermafrostRoleListView.as_view(), request)
+
+        audit.flush()
+        event = PermafrostAuditEvent.objects.get()
+        self.assertEqual(
+            (event.action, event.site_id, event.actor_id),
+            ("permission_denied", 2, self.user.pk),
+        )
+        self.assertEqual(event.details["path"], "/manage/")
+        self.assertEqual(event.details["missing"], event.details["required"])
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["permafrost.backends.PermafrostModelBackend"]
+    )
+    def test_denied_checks_record_the_site_and_permissions_checked(self):
+        class SiteIdView(PermafrostMixin, View):
+            permission_required = ("permafrost.view_permafrostrole",)
+
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Administrator, site 2
+        request = RequestFactory().get("/manage/")
+        request.user = self.user
+        request.site = Site.objects.get(pk=2)  # The view checks the SITE_ID Site
+        self.assertRaises(PermissionDenied, SiteIdView.as_view(), request)
+
+        audit.flush()
+        event = PermafrostAuditEvent.objects.get(action="permission_denied")
+        self.assertEqual(event.site_id, 1)
+        self.assertEqual(event.details["missing"], ["permafrost.view_permafrostrole"])
+
+    def test_denied_checks_behind_the_site_middleware_are_recorded(self):
+        request = RequestFactory().get("/manage/")
+        request.user = self.user
+        middleware = PermafrostSiteMiddleware(PermafrostRoleListView.as_view())
+        self.assertRaises(PermissionDenied, middleware, request)
+
+        audit.flush()
+        event = PermafrostAuditEvent.objects.get()
+        self.assertEqual((event.action, event.site_id), ("permission_denied", 1))
+        self.assertEqual(event.details["missing"], event.details["required"])
+
+    def test_file_writer_is_flushed_from_the_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "audit.log")
+            buffer = AuditBuffer(FileWriter(filename), flush_interval=0.01)
+            self.addCleanup(buffer.close)
+
+            with self.assertNumQueries(0):
+                buffer.add([{"action": "users_cleared", "role_id": 4}])
+
+            for attempt in range(500):
+                if os.path.exists(filename) and os.path.getsize(filename):
+                    break
+                time.sleep(0.01)
+
+            with open(filename) as log:
+                self.assertEqual(
+                    json.loads(log.readline()),
+                    {"action": "users_cleared", "role_id": 4},
+                )
+
+
+class PermafrostDeniedLogTests(TestCase):
+
+    fixtures = ["unit_test"]
+
+    class LoggedView(PermafrostLogMixin, PermafrostSiteMixin, View):
+        permission_required = ("permafrost.view_permafrostrole",)
+
+        def get(self, request):
+            return HttpResponse()
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="jacob", email="jacob@…", password="top_secret"
+        )
+        PermafrostRole.objects.get(pk=1).users_add(self.user)  # Student, site 1
+
+    def deny(self):
+        request = RequestFactory().get("/manage/", REMOTE_ADDR="10.0.0.1")
+        request.user = self.user
+        request.site = Site.objects.get(pk=1)
+        self.assertRaises(PermissionDenied, self.LoggedView.as_view(), request)
+
+    def test_denied_checks_are_logged_as_structured_records(self):
+        with self.assertLogs("permafrost", "INFO") as logs:
+            self.deny()
+
+        record = logs.records[0]
+        self.assertTrue(
+            record.getMessage().startswith(
+                "Failed-Permission-Check:403:10.0.0.1:jacob:%s:GET:/manage/:"
+                % self.user.pk
+            )
+        )
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual(data["logger"], "permafrost")
+        self.assertEqual(data["user_id"], self.user.pk)
+        self.assertEqual(
+            data["required_permissions"], ["permafrost.view_permafrostrole"]
+        )
+        self.assertNotIn("permafrost.view_permafrostrole", data["user_permissions"])
+
+    def test_permissions_are_only_loaded_for_emitted_records(self):
+        request = RequestFactory().get("/manage/")
+        request.user = self.user
+        load_permissions = Mock(return_value={"permafrost.view_permafrostrole"})
+
+        logging.getLogger("permafrost.quiet").setLevel(logging.WARNING)
+        log_denied("permafrost.quiet", request, "10.0.0.1", [], load_permissions)
+        load_permissions.assert_not_called()
+
+        with self.assertLogs("permafrost", "INFO"):
+            log_denied(None, request, "10.0.0.1", [], load_permissions)
+        load_permissions.assert_called_once()
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["permafrost.backends.PermafrostModelBackend"]
+    )
+    def test_logs_the_permissions_the_view_checked(self):
+        class SiteIdView(PermafrostLogMixin, PermafrostMixin, View):
+            permission_required = ("permafrost.view_permafrostrole",)
+
+        PermafrostRole.objects.get(pk=3).users_add(self.user)  # Administrator, site 2
+        request = RequestFactory().get("/manage/")
+        request.user = self.user
+        request.site = Site.objects.get(pk=2)  # The view checks the SITE_ID Site
+
+        with self.assertLogs("permafrost", "INFO") as logs:
+            self.assertRaises(PermissionDenied, SiteIdView.as_view(), request)
+
+        data = json.loads(JSONFormatter().format(logs.records[0]))
+        self.assertNotIn("permafrost.view_permafrostrole", data["user_permissions"])
+
+    @override_settings(PERMAFROST_DENIED_LOG_RATE_LIMIT=(2, 60))
+    def test_denied_logs_are_rate_limited_per_user(self):
+        with self.assertLogs("permafrost", "INFO") as logs:
+            for attempt in range(5):
+                self.deny()
+        self.assertEqual(len(logs.records), 2)
+
+    @override_settings(PERMAFROST_DENIED_LOG_SAMPLE_RATE=0)
+    def test_denied_logs_can_be_sampled(self):
+        with self.assertNoLogs("permafrost", "INFO"):
+            self.deny()
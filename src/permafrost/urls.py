@@ -23,6 +23,27 @@ urlpatterns = [
         views.PermafrostRoleDeleteView.as_view(),
         name="role-delete",
     ),
+    path(
+        "role/<slug:slug>/users/",
+        views.PermafrostRoleUserListView.as_view(),
+        name="role-users",
+    ),
+    path(
+        "role/<slug:slug>/users/export/",
+        views.PermafrostRoleUserExportView.as_view(),
+        name="role-users-export",
+    ),
+    path("users/roles/", views.PermafrostUserRolesView.as_view(), name="user-roles"),
+    path(
+        "users/<str:user_pk>/roles/",
+        views.PermafrostUserRolesView.as_view(),
+        name="user-roles-detail",
+    ),
+    path(
+        "permissions/<str:permission>/",
+        views.PermafrostPermissionHoldersView.as_view(),
+        name="permission-holders",
+    ),
     path(
         "role/<slug:slug>/permissions/add",
         views.PermafrostCustomRoleModalView.as_view(),
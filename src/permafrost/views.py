@@ -1,24 +1,32 @@
-import logging
+import csv
+import json
+from types import MappingProxyType
 from django.urls import reverse_lazy
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.contrib.auth.mixins import PermissionRequiredMixin
+from django.contrib.sites.models import Site
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.views.generic import (
+    View,
+    TemplateView,
     ListView,
     DetailView,
     UpdateView,
     DeleteView,
 )
-from django.core.exceptions import ImproperlyConfigured
-from django.db.models import Q
+from django.core.exceptions import BadRequest, ValidationError
+from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import CreateView
 
 from .models import (
     PermafrostRole,
     PERMAFROST_EXCLUDED_ROLES,
-    get_optional_by_category,
-    get_required_by_category,
-    get_all_perms_for_all_categories,
+    category_registry,
+    get_permission_content_type,
+    users_with_permission,
 )
 
 from .forms import (
@@ -26,8 +34,13 @@ from .forms import (
     PermafrostRoleUpdateForm,
     SelectPermafrostRoleTypeForm,
 )
-from .permissions import has_all_permissions
-from django.contrib.sites.models import Site
+from . import audit
+from .instrumentation import instrumented
+from .logs import log_denied
+from .middleware import aget_request_permissions, get_request_permissions
+from .permissions import ahas_all_permissions, has_all_permissions
+from .search import get_permission_search_index
+from .sites import aget_request_site, get_active_site, get_request_site
 
 # --------------
 # UTILITIES
@@ -43,24 +56,205 @@ def get_client_ip(request):
     return ip
 
 
-def group_permission_categories(required, optional, selected_optional):
-    permission_categories = {}
-    for permission in set(required + optional):
-        permission_type_key = "required" if permission in required else "optional"
-        if permission.content_type.model not in permission_categories:
-            permission_categories[permission.content_type.model] = {
-                "name": permission.content_type.name,
+def get_checked_permissions(request):
+    """
+    The user's permissions on the request's Site as already loaded by the
+    permission check (or PermafrostSiteMiddleware), so logging a denied check
+    does not evaluate them again.
+    """
+    perms = getattr(request, "permafrost_perms", None)
+    if perms is None:
+        perms = get_request_permissions(request, get_request_site(request))
+    return perms
+
+
+class PermissionChoice:
+    """
+    Wraps a Permission with the 'selected' state for a single form so the
+    shared Permission objects are never modified.
+    """
+
+    __slots__ = ("permission", "selected")
+
+    def __init__(self, permission, selected=False):
+        self.permission = permission
+        self.selected = selected
+
+    def __getattr__(self, name):
+        return getattr(self.permission, name)
+
+    def __str__(self):
+        return str(self.permission)
+
+
+def build_permission_layout(required, optional, ordered=False):
+    """
+    Groups the permissions by content type model into a read-only layout:
+    {model: {"name": ..., "required": (...), "optional": (...)}}
+
+    Permissions are sorted by pk unless they are already ordered (e.g. ranked
+    search results).
+    """
+    required_ids = {permission.pk for permission in required}
+    permissions = {
+        permission.pk: permission for permission in list(required) + list(optional)
+    }
+
+    layout = {}
+    for pk in permissions if ordered else sorted(permissions):
+        permission = permissions[pk]
+        permission_type_key = "required" if pk in required_ids else "optional"
+        content_type = get_permission_content_type(permission)
+        if content_type.model not in layout:
+            layout[content_type.model] = {
+                "name": content_type.name,
                 "optional": [],
                 "required": [],
             }
-        if permission in selected_optional:
-            permission.selected = True
-        permission_categories[permission.content_type.model][
-            permission_type_key
-        ].append(permission)
+        layout[content_type.model][permission_type_key].append(permission)
+
+    return MappingProxyType(
+        {
+            model: MappingProxyType(
+                {
+                    "name": group["name"],
+                    "optional": tuple(group["optional"]),
+                    "required": tuple(group["required"]),
+                }
+            )
+            for model, group in layout.items()
+        }
+    )
+
+
+def get_category_layout(category):
+    """
+    The permission layout for a category, built once and kept in the
+    category registry until it is cleared.
+    """
+    return category_registry.memoize(
+        ("layout", category),
+        lambda: build_permission_layout(
+            category_registry.required(category), category_registry.optional(category)
+        ),
+    )
+
+
+def apply_permission_selection(*layouts, selected_ids=()):
+    """
+    Merges the layouts into the per-request 'permission_categories' context,
+    wrapping each permission in a PermissionChoice that is selected if its pk
+    is in selected_ids.
+    """
+    permission_categories = {}
+    for layout in layouts:
+        for model, group in layout.items():
+            if model not in permission_categories:
+                permission_categories[model] = {
+                    "name": group["name"],
+                    "optional": [],
+                    "required": [],
+                }
+            for permission_type_key in ("optional", "required"):
+                permission_categories[model][permission_type_key].extend(
+                    PermissionChoice(permission, permission.pk in selected_ids)
+                    for permission in group[permission_type_key]
+                )
     return permission_categories
 
 
+def group_permission_categories(required, optional, selected_optional):
+    return apply_permission_selection(
+        build_permission_layout(required, optional),
+        selected_ids={permission.pk for permission in selected_optional},
+    )
+
+
+def keyset_page(queryset, after=None, page_size=50, key="pk"):
+    """
+    Returns up to page_size rows of the queryset ordered by key, starting after
+    the given cursor, and the cursor for the next page (None on the last
+    page).  Unlike OFFSET pagination every page costs the same to fetch.
+    """
+    try:
+        if after not in (None, ""):
+            queryset = queryset.filter(**{key + "__gt": after})
+        rows = list(queryset.order_by(key)[: page_size + 1])
+    except (ValueError, ValidationError):
+        raise BadRequest("Invalid cursor: %r" % after)
+
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    return rows, getattr(rows[-1], key)
+
+
+def get_user_export_fields():
+    """
+    The user columns shown in role user lists and exports.
+    """
+    User = get_user_model()
+    fields = ["pk", User.USERNAME_FIELD]
+    email_field = User.get_email_field_name()
+    if email_field not in fields and hasattr(User, email_field):
+        fields.append(email_field)
+    return fields
+
+
+class Echo:
+    """
+    File-like object that hands back what is written to it, so csv.writer
+    can be used to build the rows of a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(fields, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(fields, rows):
+    yield "["
+    separator = ""
+    for row in rows:
+        yield separator + json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder)
+        separator = ","
+    yield "]"
+
+
+def serialize_user_roles(user, roles):
+    """
+    A user's roles and the effective permissions they grant, as returned by
+    the user roles view.  Expects the roles from PermafrostRole.objects.for_users
+    (with their Group permissions prefetched).
+    """
+    permissions = {
+        "%s.%s" % (permission.content_type.app_label, permission.codename)
+        for role in roles
+        for permission in role.group.permissions.all()
+    }
+    return {
+        "pk": user.pk,
+        "username": user.get_username(),
+        "roles": [
+            {
+                "pk": role.pk,
+                "name": role.name,
+                "slug": role.slug,
+                "category": role.category,
+            }
+            for role in roles
+        ],
+        "permissions": sorted(permissions),
+    }
+
+
 # --------------
 # MIXIN VIEWS
 # --------------
@@ -100,56 +294,113 @@ class PermafrostMixin(PermissionRequiredMixin):
 
         return set(list(perms) + list(method_perms))
 
+    @instrumented("PermafrostMixin.has_permission")
+    def has_permission(self):
+        return super().has_permission()
+
+    def get_checked_permissions(self):
+        """
+        The permissions has_permission checked the required ones against,
+        here the user's permissions from the backends (cached by them).
+        """
+        return self.request.user.get_all_permissions()
+
+    def get_checked_site(self):
+        """
+        The Site the backends checked the permissions on.
+        """
+        return get_active_site() or Site.objects.get_current()
+
+    def handle_no_permission(self):
+        if audit.is_enabled():
+            required = self.get_permission_required()
+            audit.record(
+                "permission_denied",
+                site=self.get_checked_site(),
+                actor=self.request.user,
+                on_commit=False,
+                method=self.request.method,
+                path=self.request.path,
+                ip=get_client_ip(self.request),
+                required=sorted(required),
+                missing=sorted(
+                    set(required).difference(self.get_checked_permissions())
+                ),
+            )
+        return super().handle_no_permission()
+
 
 class PermafrostSiteMixin(PermafrostMixin):
     """
     This mixin can be added to a View to create a new method for retrieving permissions for users based on their per-site permafrost roles using request.site rather than SITE_ID.
     """
 
+    @instrumented("PermafrostSiteMixin.has_permission")
     def has_permission(self):
 
         check_list = self.get_permission_required()
 
         return has_all_permissions(self.request, check_list)
 
+    def get_checked_permissions(self):
+        return get_checked_permissions(self.request)
+
+    def get_checked_site(self):
+        return get_request_site(self.request)
+
+
+class PermafrostAsyncSiteMixin(PermafrostMixin):
+    """
+    PermafrostSiteMixin for class-based views with async handlers ('async def
+    get', ...).  Permissions are checked with ahas_all_permissions, so the
+    check stays on the event loop instead of going through sync_to_async.
+    """
+
+    @instrumented("PermafrostAsyncSiteMixin.has_permission")
+    async def ahas_permission(self):
+        return await ahas_all_permissions(self.request, self.get_permission_required())
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not await self.ahas_permission():
+            # Loaded here as handle_no_permission can not query the database
+            self.checked_permissions = await aget_request_permissions(
+                request, await aget_request_site(request)
+            )
+            return self.handle_no_permission()
+        # Skips PermissionRequiredMixin.dispatch and its sync check
+        return await super(PermissionRequiredMixin, self).dispatch(
+            request, *args, **kwargs
+        )
+
+    def get_checked_permissions(self):
+        return self.checked_permissions
+
+    def get_checked_site(self):
+        return get_request_site(self.request)  # Resolved by dispatch
+
 
 class PermafrostLogMixin(object):
     """
-    A mixin that lets you define a logger in which to write failed permission attempts to.
+    A mixin that logs failed permission attempts to permission_logger, the
+    "permafrost" logger by default, with the permissions the view checked
+    (see PermafrostMixin.get_checked_permissions).  See permafrost.logs for
+    the record's fields, sampling and rate limiting.
     """
 
     permission_logger = None
 
     def handle_no_permission(self):
-
-        if (
-            self.permission_logger is None
-        ):  # TODO Make this assume a default logger called "permafrost"
-            raise ImproperlyConfigured(
-                "{0} is missing the permission_logger attribute. Define {0}.permission_logger".format(
-                    self.__class__.__name__
-                )
-            )
-
-        logger = logging.getLogger(self.permission_logger)
-
-        user_ip = get_client_ip(self.request)
-        user_perms = list(self.request.user.get_all_permissions())
-        view_perms = list(self.get_permission_required())
-
-        logger.info(
-            "Failed-Permission-Check:403:{0}:{1}:{2}:{3}:{4}:{5}:{6}".format(  # Should be replaced with a Formater
-                user_ip,
-                self.request.user.username,
-                self.request.user.pk,
-                self.request.method,
-                self.request.path,
-                ",".join(user_perms),
-                ",".join(view_perms),
-            )
+        log_denied(
+            self.permission_logger,
+            self.request,
+            get_client_ip(self.request),
+            self.get_permission_required(),
+            getattr(
+                self, "get_checked_permissions", self.request.user.get_all_permissions
+            ),
         )
 
-        super().handle_no_permission()
+        return super().handle_no_permission()
 
 
 class FilterByRequestSiteQuerysetMixin:
@@ -160,16 +411,20 @@ class FilterByRequestSiteQuerysetMixin:
 
 
 class GetRoleExternalPermissionsMixin:
-    def get_perms_excluding_current_role(self, context):
+    def get_current_role_perm_ids(self, context):
         role = context["object"]
-        required = role.required_permissions()
-        optional = role.optional_permissions()
-        selected = list(role.permissions().all())
-        all_perms = get_all_perms_for_all_categories()
-        perms_excluding_current_role = list(
-            set(all_perms) - set(required + optional + selected)
+        return role.all_perm_ids().union(
+            role.permissions().values_list("pk", flat=True)
+        )
+
+    def get_perms_excluding_current_role(self, context, query=""):
+        """
+        Category permissions outside of the role's own and selected ones,
+        matching the query (best match first) if there is one.
+        """
+        return get_permission_search_index().search(
+            query, exclude=self.get_current_role_perm_ids(context)
         )
-        return perms_excluding_current_role
 
 
 # Create Permission Group
@@ -189,11 +444,8 @@ class PermafrostRoleCreateView(PermafrostSiteMixin, CreateView):
 
                 form = PermafrostRoleCreateForm(**kwargs)
                 category = submitted.cleaned_data["category"]
-                required = get_required_by_category(category=category)
-                optional = get_optional_by_category(category=category)
-                selected_optional = []
-                permission_categories = group_permission_categories(
-                    required, optional, selected_optional
+                permission_categories = apply_permission_selection(
+                    get_category_layout(category)
                 )
             else:
                 form = submitted
@@ -298,15 +550,15 @@ class PermafrostRoleUpdateView(
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         role = context["object"]
-        required = role.required_permissions()
-        optional = role.optional_permissions()
-        other = list(role.permissions().all())
-        optional = list(set(optional + other))
-        selected_optional = role.permissions().filter(
-            id__in=[permission.id for permission in optional]
-        )
-        context["permission_categories"] = group_permission_categories(
-            required, optional, selected_optional
+        selected = list(role.permissions().select_related("content_type"))
+        category_ids = role.all_perm_ids()
+        other = [
+            permission for permission in selected if permission.pk not in category_ids
+        ]  # Permissions added outside of the category are shown as optional
+        context["permission_categories"] = apply_permission_selection(
+            get_category_layout(role.category),
+            build_permission_layout([], other),
+            selected_ids={permission.pk for permission in selected},
         )
         return context
 
@@ -339,22 +591,13 @@ class PermafrostCustomRoleModalView(
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        perms_excluding_current_role = self.get_perms_excluding_current_role(context)
-        query = self.request.GET.get("q", None)
-
-        if query:
-            # perform search filtering
-            perms_pks = [perm.pk for perm in perms_excluding_current_role]
-            filter1 = Q(name__icontains=query)
-            # filter2 = Q(content_type__name__icontains=query) # TODO why does this filter not work?
-            # @fahzee1 tried adding the filter back, i think because name is an @property on the model and not a db column
-            perms_queryset = Permission.objects.filter(pk__in=perms_pks)
-            perms_to_group = list(perms_queryset.filter(filter1))
-        else:
-            perms_to_group = perms_excluding_current_role
+        query = self.request.GET.get("q", None) or ""
+
+        # Searches name, codename, app label and content type name in memory
+        perms_to_group = self.get_perms_excluding_current_role(context, query)
 
-        context["permission_categories"] = group_permission_categories(
-            [], perms_to_group, []
+        context["permission_categories"] = apply_permission_selection(
+            build_permission_layout([], perms_to_group, ordered=True)
         )
         return context
 
@@ -364,11 +607,11 @@ class PermafrostCustomRoleModalView(
         return ["permafrost/includes/permissions_table.html"]
 
     def post(self, request, slug, *args, **kwargs):
-        current_site = getattr(request, "site", Site.objects.get_current())
+        current_site = get_request_site(request)
         role = PermafrostRole.objects.filter(site=current_site, slug=slug).last()
         perms_to_add = self.get_permissions_queryset()
         if perms_to_add:
-            role.group.permissions.add(*perms_to_add)
+            role.permissions_add(*perms_to_add)
         return redirect("permafrost:role-update", slug=slug)
 
     def get_permissions_queryset(self):
@@ -378,10 +621,224 @@ class PermafrostCustomRoleModalView(
         return None
 
 
-# Future Views
+# Role User List
+class PermafrostRoleUserListView(
+    PermafrostSiteMixin, FilterByRequestSiteQuerysetMixin, DetailView
+):
+    """
+    Lists the users of a role a page at a time, using the last user pk of the
+    page as the cursor for the next one ('?after=<pk>'), and adds or removes
+    the posted 'users' in bulk.
+    """
+
+    model = PermafrostRole
+    template_name = "permafrost/permafrostrole_user_list.html"
+    queryset = PermafrostRole.on_site.all()
+    permission_required = ["permafrost.view_permafrostrole"]
+    permission_required_post = ["permafrost.add_user_to_role"]
+    paginate_by = 50
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        fields = get_user_export_fields()
+        users, next_cursor = keyset_page(
+            self.object.user_set().only(*fields[1:]),
+            after=self.request.GET.get("after"),
+            page_size=self.paginate_by,
+        )
+        context["user_list"] = users
+        context["next_cursor"] = next_cursor
+        return context
+
+    def get_posted_user_ids(self):
+        user_ids = [
+            value.strip()
+            for values in self.request.POST.getlist("users")
+            for value in values.split(",")
+            if value.strip()
+        ]
+        try:
+            return list(
+                get_user_model()
+                .objects.filter(pk__in=user_ids)
+                .values_list("pk", flat=True)
+            )
+        except (ValueError, ValidationError):
+            raise BadRequest("Invalid user id")
+
+    def post(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        action = request.POST.get("action")
+
+        if action not in ("add", "remove"):
+            raise BadRequest("Unknown action: %r" % action)
+
+        assignments = [(user_id, self.object) for user_id in self.get_posted_user_ids()]
+        if action == "add":
+            PermafrostRole.objects.add_users(assignments)
+        else:
+            PermafrostRole.objects.remove_users(assignments)
+
+        return redirect("permafrost:role-users", slug=self.object.slug)
+
 
-# TODO: Role User List (For easier pagination) & bulk editing
+# Role User Export
+class PermafrostRoleUserExportView(
+    PermafrostSiteMixin, FilterByRequestSiteQuerysetMixin, SingleObjectMixin, View
+):
+    """
+    Streams every user of a role as CSV (default) or JSON ('?format=json'),
+    reading them from the database in chunks.
+    """
 
-# TODO: User Roles on a given Site
+    model = PermafrostRole
+    queryset = PermafrostRole.on_site.all()
+    permission_required = ["permafrost.view_permafrostrole"]
+    chunk_size = 2000
+
+    def get(self, request, *args, **kwargs):
+        role = self.get_object()
+        fields = get_user_export_fields()
+        rows = (
+            role.user_set()
+            .order_by("pk")
+            .values_list(*fields)
+            .iterator(chunk_size=self.chunk_size)
+        )
+
+        if request.GET.get("format") == "json":
+            content_type, extension = "application/json", "json"
+            content = stream_json(fields, rows)
+        else:
+            content_type, extension = "text/csv", "csv"
+            content = stream_csv(fields, rows)
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="%s-users.%s"' % (
+            role.slug,
+            extension,
+        )
+        return response
+
+
+# User Roles on a Site
+class PermafrostUserRolesView(PermafrostSiteMixin, TemplateView):
+    """
+    Shows the PermafrostRoles users have on the current site together with the
+    effective permissions they grant: a single user when 'user_pk' is given,
+    otherwise a page of the users with a role on the site ('?after=<pk>').
+    Add '?format=json' to get the same data as JSON.
+    """
+
+    template_name = "permafrost/permafrostrole_user_roles.html"
+    permission_required = ["permafrost.view_permafrostrole"]
+    paginate_by = 50
+
+    def get_site(self):
+        return get_request_site(self.request)
+
+    def get_users(self, site):
+        """
+        Returns the users to show and the cursor for the next page.
+        """
+        User = get_user_model()
+        users = User.objects.only(User.USERNAME_FIELD).filter(
+            groups__permafrost_role__site=site, groups__permafrost_role__deleted=False
+        )
+
+        if "user_pk" in self.kwargs:
+            try:
+                user = users.filter(pk=self.kwargs["user_pk"]).first()
+            except (ValueError, ValidationError):
+                user = None
+            if user is None:
+                raise Http404("No user found matching the query")
+            return [user], None
+
+        users = users.distinct()
+        return keyset_page(
+            users, after=self.request.GET.get("after"), page_size=self.paginate_by
+        )
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        site = self.get_site()
+        users, next_cursor = self.get_users(site)
+        roles = PermafrostRole.objects.for_users(users, site)
+
+        context["user_roles"] = [
+            serialize_user_roles(user, roles[user.pk]) for user in users
+        ]
+        context["next_cursor"] = next_cursor
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get("format") == "json":
+            return JsonResponse(
+                {"results": context["user_roles"], "next": context["next_cursor"]}
+            )
+        return super().render_to_response(context, **response_kwargs)
+
+
+# Roles & Users with a Permission
+class PermafrostPermissionHoldersView(PermafrostSiteMixin, TemplateView):
+    """
+    Shows which roles on the current site grant a permission ("app.codename")
+    and a page of the users that hold it through them ('?after=<pk>').  Add
+    '?counts=1' for the number of users per role and in total, and
+    '?format=json' to get the same data as JSON.
+    """
+
+    template_name = "permafrost/permafrostrole_permission_holders.html"
+    permission_required = ["permafrost.view_permafrostrole"]
+    paginate_by = 50
+
+    def get_site(self):
+        return get_request_site(self.request)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        permission = self.kwargs["permission"]
+        if "." not in permission:
+            raise Http404("Permissions are given as 'app_label.codename'")
+
+        site = self.get_site()
+        counts = bool(self.request.GET.get("counts"))
+        User = get_user_model()
+
+        roles = PermafrostRole.objects.with_permission(
+            permission, site=site, counts=counts
+        ).order_by("name", "pk")
+        users = users_with_permission(permission, site=site)
+        user_list, next_cursor = keyset_page(
+            users.only(User.USERNAME_FIELD),
+            after=self.request.GET.get("after"),
+            page_size=self.paginate_by,
+        )
+
+        context["permission"] = permission
+        context["roles"] = [
+            {
+                "pk": role.pk,
+                "name": role.name,
+                "slug": role.slug,
+                "category": role.category,
+                **({"user_count": role.user_count} if counts else {}),
+            }
+            for role in roles
+        ]
+        context["users"] = [
+            {"pk": user.pk, "username": user.get_username()} for user in user_list
+        ]
+        context["next_cursor"] = next_cursor
+        if counts:
+            context["user_count"] = users.count()
+        return context
 
-# TODO: Roles with a given permission
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get("format") == "json":
+            keys = ("permission", "roles", "users", "user_count")
+            data = {key: context[key] for key in keys if key in context}
+            data["next"] = context["next_cursor"]
+            return JsonResponse(data)
+        return super().render_to_response(context, **response_kwargs)